@@ -1,84 +1,372 @@
 #!/usr/bin/env python
 import os
-import importlib
 import configparser
+import multiprocessing
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 
-from smw_api_handler import SemanticMediaWikiApiHandler
-from logger import Logger
+from smw_api_handler import SemanticMediaWikiApiHandler, PageExistsError
+from page_index_allocator import PageIndexAllocator, PageIndexError
+from sync_index import SyncIndex
+from plugin_registry import PluginRegistry
+from wikitext_renderer import WikitextRenderer
+import metrics
+from logger import Logger, configure_logging
 
 import warnings  # dismiss the Unverified HTTPS request warning
 # warnings.filterwarnings('ignore', message='Unverified HTTPS request')
 
+MAX_TITLE_ATTEMPTS = 5  # Number of indices tried if page titles are already taken
+PROTOCOL_INDEX_QUERY_LIMIT = 500  # Number of protocol pages fetched to find the highest index of several protocol types
+
+configs = {}  # config file path -> configuration, read once per process
+configs_lock = threading.Lock()
+
+# Returns the adapter configuration. The file is read once per process and all callers get the same object, so the
+# plugins, templates and other per configuration objects are also created once, e.g. for every Adapter() without config.
+# The environment variable ELN_SMW_ADAPTER_CONFIG can point to another config file, e.g. for benchmarks
+def load_config():
+    path = os.environ.get('ELN_SMW_ADAPTER_CONFIG', os.path.join(os.path.dirname(__file__), 'config/config.ini'))
+    with configs_lock:
+        if path not in configs:
+            config = configparser.ConfigParser()
+            config.read(path)
+            configs[path] = config
+        return configs[path]
+
 class Adapter:
-    def __init__(self):
-        self.logger = Logger()
-        self.config = configparser.ConfigParser()
-        self.config.read(os.path.join(os.path.dirname(__file__), 'config/config.ini'))
-        self.smw_api = SemanticMediaWikiApiHandler(self.config)
+    # Worker processes parsing the experiments of bulk calls, started once per process on the first bulk call.
+    # They are spawned instead of forked, forking a process with running threads (gunicorn gthread workers) can copy locks held by other threads
+    parse_executor = None
+    parse_executor_lock = threading.Lock()
+
+    def __init__(self, config=None, smw_api=None, page_index_allocator=None, request_id=None, page_callback=None, include_page_bodies=True):
+        self.config = config if config is not None else load_config()
+        configure_logging(self.config)  # [Logging] settings apply if this is the first adapter of the process, e.g. in bulk_adapt.py
+        self.logger = Logger(request_id=request_id)  # every log line of this adapter is tagged with the request id
+        # use a handler from the shared session pool if given, otherwise log in with a new session
+        self.smw_api = smw_api if smw_api is not None else SemanticMediaWikiApiHandler(self.config)
+        # adapters of a bulk call share one allocator, so indices are fetched once per category for all experiments
+        self.page_index_allocator = page_index_allocator if page_index_allocator is not None else PageIndexAllocator(self.smw_api, self.config)
+        self.plugin_registry = PluginRegistry.for_config(self.config)  # plugins are imported once per process on first use
+        self.sync_index = SyncIndex.from_config(self.config)  # titles and content hashes of pages written in previous runs
+        self.renderer = WikitextRenderer.for_config(self.config)  # page templates are compiled once per process
         self.smw_pages = {} # Dictionary of created wiki pages with name and content for response
+        self.include_page_bodies = include_page_bodies  # if not set, created pages are listed with None instead of their content
+        self.page_callback = page_callback  # called with a dict (category, title, status, size) per page as soon as it is written
         self.messages = [] # List with info, warnings and errors for response
+        self.timer = metrics.StageTimer()  # timing spans of fetch, parse, index allocation and smw api requests
         self.source = None
 
-    def adapt(self, eln, id):
+    # Returns the response object, with timings set it contains the timing spans of all stages of the run
+    def adapt(self, eln, id, timings=False):
         self.logger.log_message('info', 'Call for Plugin {} with page id {}'.format(eln, id))
+        csrf_token_reuses = self.smw_api.csrf_token_reuses
+        self.timer.plugin = eln
+        start = time.perf_counter()
+
+        # run plugin determined by eln parameter
+        self.source = self.plugin_registry.get(eln, self)
+        self.smw_api.stage_timer = self.timer
+        try:
+            if self.source:
+                self.source.run(id)
+            else:
+                self.add_plugin_missing_message(eln)
+        except PageIndexError as e:
+            # the wiki is unavailable, pages written so far and the error are returned
+            self.logger.log_message('error', str(e))
+            self.add_message('error', '{}. Please try again later.'.format(e))
+        finally:
+            self.smw_api.stage_timer = None
+            metrics.registry.increment('adapter_runs_total', {'plugin': eln})
+            metrics.registry.observe('adapter_run_duration_seconds', time.perf_counter() - start, {'plugin': eln})
+
+        # Number of token requests saved by the token cache of the smw api handler during this run
+        csrf_token_fetches_avoided = self.smw_api.csrf_token_reuses - csrf_token_reuses
+        self.logger.log_message('info', 'CSRF token fetches avoided: {}'.format(csrf_token_fetches_avoided))
+        self.logger.log_runtime()
+
+        response = self.get_response()
+        response['statistics'] = {'csrf_token_fetches_avoided': csrf_token_fetches_avoided}
+        if timings:
+            response['timings'] = self.timer.spans
+        return response
+
+    # Adapts many experiments and yields one response object per experiment as soon as its pages are written.
+    # Experiments are fetched concurrently and parsed in worker processes, pages are written with the session of this adapter.
+    def adapt_bulk(self, eln, ids=None, query=None, timings=False):
+        self.logger.log_message('info', 'Bulk call for Plugin {} with page ids {} and query {}'.format(eln, ids, query))
+        self.source = self.plugin_registry.get(eln, self)
+        if not self.source:
+            self.add_plugin_missing_message(eln)
+            yield self.get_bulk_response(eln, None)
+            return
+
+        ids = list(ids or [])
+        if query:
+            ids += self.source.search(query)
+            for message in self.messages:
+                yield {'eln': eln, 'query': query, 'message': message}
 
-        # import and run plugin dynamically by determined by eln parameter
-        self.source = importlib.import_module('plugins.' + eln.lower(), '.').Plugin(self.config, self)
-        self.source.run(id)
+        # one adapter per experiment collects its pages and messages
+        adapters = {}
+        for id in ids:
+            adapter = Adapter(self.config, self.smw_api, self.page_index_allocator, '{}-{}'.format(self.logger.request_id, id),
+                              include_page_bodies=self.include_page_bodies)
+            adapter.timer.plugin = eln
+            adapter.source = self.plugin_registry.get(eln, adapter)
+            adapters.setdefault(str(id), (id, adapter))
+
+        # plugins without bulk functions adapt one experiment after another
+        if not hasattr(self.source, 'parse_task'):
+            for id, adapter in adapters.values():
+                self.smw_api.stage_timer = adapter.timer
+                try:
+                    adapter.source.run(id)
+                except Exception as e:
+                    adapter.logger.log_message('error', 'Bulk adapt of {} {} failed: {}'.format(eln, id, e))
+                    adapter.add_message('error', 'Adapting {} {} failed: {}'.format(eln, id, e))
+                finally:
+                    self.smw_api.stage_timer = None
+                yield adapter.get_bulk_response(eln, id, timings)
+            self.logger.log_runtime()
+            return
+
+        fetch_workers = self.config.getint('Bulk', 'fetch_workers', fallback=4)
+        parse_executor = Adapter.get_parse_executor(self.config)
+        with ThreadPoolExecutor(max_workers=fetch_workers) as fetch_executor:
+            futures = {}  # future -> (id, adapter, fetched document or None while fetching)
+            for id, adapter in adapters.values():
+                futures[fetch_executor.submit(adapter.source.fetch, id)] = (id, adapter, None)
+
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    id, adapter, document = futures.pop(future)
+                    try:
+                        if document is None:
+                            # fetched, parse in a worker process
+                            document = future.result()
+                            if document is not None:
+                                parse_function, parse_arguments = adapter.source.parse_task(document)
+                                futures[parse_executor.submit(parse_function, *parse_arguments)] = (id, adapter, document)
+                                continue
+                        else:
+                            # parsed, write pages
+                            self.smw_api.stage_timer = adapter.timer
+                            adapter.source.create_pages(id, document, future.result())
+                    except Exception as e:
+                        adapter.logger.log_message('error', 'Bulk adapt of {} {} failed: {}'.format(eln, id, e))
+                        adapter.add_message('error', 'Adapting {} {} failed: {}'.format(eln, id, e))
+                        if isinstance(e, BrokenProcessPool):
+                            # a worker process died, the remaining experiments are parsed by new workers
+                            parse_executor = Adapter.get_parse_executor(self.config, parse_executor)
+                    self.smw_api.stage_timer = None
+                    yield adapter.get_bulk_response(eln, id, timings)
 
         self.logger.log_runtime()
 
-        # Response object contains adapter version, created smw pages and messages with info, warnings and errors
+    # Returns the worker processes for parsing, new ones are started on the first call or if broken_executor is the current one
+    @staticmethod
+    def get_parse_executor(config, broken_executor=None):
+        with Adapter.parse_executor_lock:
+            if Adapter.parse_executor is None or Adapter.parse_executor is broken_executor:
+                Adapter.parse_executor = ProcessPoolExecutor(max_workers=config.getint('Bulk', 'parse_workers', fallback=2),
+                                                             mp_context=multiprocessing.get_context('spawn'))
+            return Adapter.parse_executor
+
+    # Response object contains adapter version, created smw pages and messages with info, warnings and errors
+    def get_response(self):
         response = {}
         response['version'] = self.config['Main']['version']
+        response['request_id'] = self.logger.request_id
         response['smw_pages'] = self.smw_pages
         response['messages'] = self.messages
         return response
 
-    # Creates a new SMW page with content in wiki syntax
-    def create_smw_page(self, category, data):
-        new_title = None
-        text = None
+    def get_bulk_response(self, eln, id, timings=False):
+        response = self.get_response()
+        response['eln'] = eln
+        response['id'] = id
+        if timings:
+            response['timings'] = self.timer.spans
+        return response
+
+    # Creates a new SMW page with content in wiki syntax. With a sync_key (origin, origin internal identifier, table position)
+    # the page of a previous run for the same table is updated instead, or skipped if its content did not change
+    def create_smw_page(self, category, data, sync_key=None):
+        return self.write_smw_page(category, data, self.new_smw_page_title(category, data, sync_key), sync_key)
+
+    # Returns the ask condition and title format of categories with numbered page titles, otherwise None
+    @staticmethod
+    def get_smw_page_numbering(category, data):
         if category == 'Specimen':
-            next_number = self.get_next_smw_page_index('[[Category:Specimen]]')
-            new_title = "S{:05}".format(next_number)
-            text = '{{{{Specimen|Description={0}|Person={1}|Material={2}}}}}'.format(data['Description'], data['Person'], data['Material']) # format replaces {{ with {
+            return '[[Category:Specimen]]', "S{:05}"
         elif category == 'Protocol':
-            next_number = self.get_next_smw_page_index('[[Category:Protocol]][[ProtocolType::{}]]'.format(data['ProtocolType']))
-            new_title = "P{}{:04}".format(data['ProtocolType'], next_number)
-            text = '{{{{Protocol|ProtocolType={0}|Date={1}|Person={2}|SpecimenList={3}|Origin={4}|OriginInternalIdentifier={5}}}}}'.format(data['ProtocolType'], data['Date'], data['Person'], data['SpecimenList'], data['Origin'], data['OriginInternalIdentifier']) # format replaces {{ with {
+            return '[[Category:Protocol]][[ProtocolType::{}]]'.format(data['ProtocolType']), "P{}{{:04}}".format(data['ProtocolType'])
+        return None
+
+    # Allocates the title of a new page, numbered pages get the next free index
+    def new_smw_page_title(self, category, data, sync_key=None):
+        synced_page = self.get_synced_smw_page(category, data, sync_key)
+        numbering = Adapter.get_smw_page_numbering(category, data)
+        if synced_page:
+            return synced_page[0]
+        elif numbering:
+            ask_condition, title_format = numbering
+            return title_format.format(self.get_next_smw_page_index(ask_condition))
         elif category == 'Record':
-            new_title = "R_{}_{}".format(data['Protocol'], data['Specimen'])
-            record_text = '{{{{Record|Protocol={0}|Specimen={1}}}}}'.format(data['Protocol'], data['Specimen']) # format replaces {{ with {
-            data_pairs = []
-            for key, value in data['Data'].items():
-                data_pairs.append(f"{key}={value}")
-            subobject_text = '{{{{#subobject:Data|{}}}}}'.format('|'.join(data_pairs))
-            text = record_text+subobject_text
-
-        self.logger.log_message('info', 'Create SMW page of category {} with title {}'.format(category, new_title))
-        if self.smw_api.edit(new_title, text):
+            return Adapter.get_record_title(data)
+        return None
+
+    @staticmethod
+    def get_record_title(data):
+        return "R_{}_{}".format(data['Protocol'], data['Specimen'])
+
+    # Returns (title, content hash) of the page written for the same sync_key in a previous run, if its title still fits the data
+    def get_synced_smw_page(self, category, data, sync_key):
+        if sync_key is None or self.sync_index is None:
+            return None
+        synced_page = self.sync_index.get(sync_key, category)
+        if synced_page is None:
+            return None
+
+        numbering = Adapter.get_smw_page_numbering(category, data)
+        # the whole title is matched, the title PHTr0003 has the prefix of protocol type HT but belongs to HTr
+        if numbering and not re.fullmatch(r'{}\d+'.format(re.escape(numbering[1].split('{')[0])), synced_page[0]):
+            return None  # e.g. the protocol type was changed in the ELN
+        if category == 'Record' and synced_page[0] != Adapter.get_record_title(data):
+            return None  # the protocol or specimen of the record got a new page
+        return synced_page
+
+    def render_smw_page(self, category, data):
+        return self.renderer.render(category, data)
+
+    # Writes the page with the given title and returns the final title. Numbered pages are created with createonly,
+    # if another request took the title in the meantime the next index is used
+    def write_smw_page(self, category, data, new_title, sync_key=None):
+        text = self.render_smw_page(category, data)
+        numbering = Adapter.get_smw_page_numbering(category, data)
+        content_hash = SyncIndex.content_hash(text)
+
+        synced_page = self.get_synced_smw_page(category, data, sync_key)
+        if synced_page and synced_page[0] != new_title:
+            synced_page = None
+        if synced_page and synced_page[1] == content_hash:
+            self.logger.log_message('info', 'Page {} is unchanged and was skipped'.format(new_title))
+            self.add_message('info', 'Page {} is unchanged since the last run'.format(new_title))
+            self.report_smw_page(category, new_title, 'unchanged', text)
+            return new_title
+
+        if synced_page:
+            # page of a previous run is overwritten with the changed content
+            self.logger.log_message('info', 'Update SMW page of category {} with title {}'.format(category, new_title))
+            created = self.smw_api.edit(new_title, text)
+        else:
+            for attempt in range(MAX_TITLE_ATTEMPTS if numbering else 1):
+                if attempt > 0:
+                    new_title = self.new_smw_page_title(category, data)
+                self.logger.log_message('info', 'Create SMW page of category {} with title {}'.format(category, new_title))
+                try:
+                    created = self.smw_api.edit(new_title, text, createonly=bool(numbering))
+                    break
+                except PageExistsError:
+                    self.logger.log_message('warning', 'Page {} already exists, retry with next index'.format(new_title))
+                    self.page_index_allocator.invalidate(numbering[0])
+                    created = False
+
+        self.add_smw_page_result(category, new_title, text, sync_key, created)
+        return new_title
+
+    # Writes several pages of a category without numbered titles (e.g. Records) with one import request.
+    # pages is a list of (data, title, sync_key), pages which were not imported are written one by one with edit
+    def write_smw_pages_batch(self, category, pages):
+        pending_pages = {}
+        for data, new_title, sync_key in pages:
+            text = self.render_smw_page(category, data)
+            synced_page = self.get_synced_smw_page(category, data, sync_key)
+            if synced_page and synced_page[0] == new_title and synced_page[1] == SyncIndex.content_hash(text):
+                self.logger.log_message('info', 'Page {} is unchanged and was skipped'.format(new_title))
+                self.add_message('info', 'Page {} is unchanged since the last run'.format(new_title))
+                self.report_smw_page(category, new_title, 'unchanged', text)
+                continue
+            self.logger.log_message('info', 'Create SMW page of category {} with title {}'.format(category, new_title))
+            pending_pages[new_title] = (data, text, sync_key)
+
+        imported = {}
+        if pending_pages:
+            imported = self.smw_api.import_pages({title: text for title, (_, text, _) in pending_pages.items()}) or {}
+
+        for new_title, (data, text, sync_key) in pending_pages.items():
+            if imported.get(new_title):
+                self.add_smw_page_result(category, new_title, text, sync_key, True)
+            else:
+                self.logger.log_message('warning', 'Page {} was not imported, falling back to edit'.format(new_title))
+                self.write_smw_page(category, data, new_title, sync_key)
+
+    def add_smw_page_result(self, category, new_title, text, sync_key, created):
+        if created:
             self.logger.log_message('info', 'Page {} was created'.format(new_title))
-            self.smw_pages[new_title] = text
+            self.smw_pages[new_title] = text if self.include_page_bodies else None
+            if sync_key is not None and self.sync_index is not None:
+                self.sync_index.put(sync_key, category, new_title, SyncIndex.content_hash(text))
         else:
             self.logger.log_message('error', 'Page {} was not created'.format(new_title))
-        return new_title
+        self.report_smw_page(category, new_title, 'written' if created else 'failed', text)
+
+    # Passes the outcome of a page write to the page callback, e.g. to stream it to the client
+    def report_smw_page(self, category, title, status, text):
+        if self.page_callback is not None:
+            self.page_callback({'category': category, 'title': title, 'status': status, 'size': len(text.encode('utf-8')) if text else 0})
 
     # Calculates index for the next page with a specific condition. E.g. Specimen, Protocols
     def get_next_smw_page_index(self, ask_condition):
-        data = self.smw_api.ask('{}|limit=1|order=desc'.format(ask_condition))
-        if data["query"]["results"]:
-            page_name = next(iter(data["query"]["results"].values()))['fulltext']
-            page_name_number =  re.search(r'(\d+)$', page_name).group(0)
-            return int(page_name_number)+1
-        else:
-            return 1
+        if ask_condition in self.page_index_allocator.synchronized_conditions:
+            return self.page_index_allocator.next_index(ask_condition)
+        with self.timer.span('index_allocation'):
+            return self.page_index_allocator.next_index(ask_condition)
+
+    # Fetches the highest index of all given protocol types with one query, so the following protocols are numbered locally
+    def reserve_smw_protocol_indices(self, protocol_types):
+        # protocol types already known to the allocator, e.g. from a previous experiment of a bulk call, are skipped
+        protocol_types = [protocol_type for protocol_type in dict.fromkeys(protocol_types)
+                          if '[[Category:Protocol]][[ProtocolType::{}]]'.format(protocol_type) not in self.page_index_allocator.synchronized_conditions]
+        if not protocol_types:
+            return
+        with self.timer.span('index_allocation'):
+            self.reserve_protocol_types(protocol_types)
+
+    def reserve_protocol_types(self, protocol_types):
+        data = self.smw_api.ask('[[Category:Protocol]][[ProtocolType::{}]]|limit={}|order=desc'.format('||'.join(protocol_types), PROTOCOL_INDEX_QUERY_LIMIT))
+        if not data or 'query' not in data:
+            return  # indices are queried per protocol type on first use
+
+        highest_indices = {}
+        for result in data['query']['results'].values():
+            for protocol_type in protocol_types:
+                match = re.fullmatch(r'P{}(\d+)'.format(re.escape(protocol_type)), result['fulltext'])
+                if match:
+                    highest_indices[protocol_type] = max(highest_indices.get(protocol_type, 0), int(match.group(1)))
+
+        # if the result was cut off by the limit, protocol types without result are queried on first use
+        complete = 'query-continue-offset' not in data
+        for protocol_type in protocol_types:
+            if protocol_type in highest_indices or complete:
+                ask_condition = '[[Category:Protocol]][[ProtocolType::{}]]'.format(protocol_type)
+                self.page_index_allocator.synchronize(ask_condition, highest_indices.get(protocol_type, 0))
 
     # add message to the response
     def add_message(self, type, text):
         self.messages.append({'type': type, 'text': text })
 
+    def add_plugin_missing_message(self, eln):
+        self.logger.log_message('error', 'No plugin enabled for {}'.format(eln))
+        self.add_message('error', 'No plugin enabled for {}. Enabled plugins: {}'.format(eln, ', '.join(self.plugin_registry.modules)))
+
     @staticmethod
     def test(specimen, protocols, records):
         print('Specimen', specimen['Name'], ':\n', specimen, '\n')
@@ -1,20 +1,132 @@
-from adapter import Adapter
-from flask import Flask, request, jsonify
+import json
+import queue
+import threading
+
+from adapter import Adapter, load_config
+from smw_session_pool import SemanticMediaWikiSessionPool, SessionPoolTimeoutError
+from job_manager import JobManager
+from plugin_registry import PluginRegistry
+from logger import configure_logging
+import metrics
+from flask import Flask, Response, request, jsonify, stream_with_context
 
 app = Flask(__name__)
 
+# Configuration, plugins and logged in SMW sessions are shared by all requests of this process
+config = load_config()
+configure_logging(config)  # log records are written by a background thread of this process
+metrics.registry.share(config)  # /metrics reports the values of all worker processes
+smw_session_pool = SemanticMediaWikiSessionPool(config)
+job_manager = JobManager(config, smw_session_pool)
+# plugins are imported on their first request, with [Server] warmup before this worker accepts requests
+if config.getboolean('Server', 'warmup', fallback=False):
+    PluginRegistry.for_config(config).warm_up()
+
 @app.route('/adapt', methods=['POST'])
 def adapt():
     data = request.get_json()
     eln = data['eln']
     experiment_id = data['id']
-    adapter = Adapter()
-    result = adapter.adapt(eln, experiment_id)
+
+    # async mode returns the job immediately, progress and result are polled from /jobs/<job_id>
+    if data.get('async'):
+        job = job_manager.submit(eln, experiment_id, data.get('timings', False), data.get('page_bodies', True))
+        return jsonify(job), 202
+
+    # stream mode sends an event per page as soon as it is written, "page_bodies": false leaves out the page contents
+    if data.get('stream'):
+        return stream_adapt(eln, experiment_id, data)
+
+    try:
+        with smw_session_pool.session() as smw_api:
+            adapter = Adapter(config, smw_api, include_page_bodies=data.get('page_bodies', True))
+            result = adapter.adapt(eln, experiment_id, data.get('timings', False))
+    except SessionPoolTimeoutError as e:
+        return session_pool_busy(e)
     return jsonify(result)
 
+# All SMW sessions of this process stayed in use for [SMW] pool_timeout seconds
+def session_pool_busy(error):
+    return jsonify(error=str(error)), 503
+
+# Runs the adapter in a background thread and streams one event per page (category, title, status, size) and the
+# response object at the end, as JSON lines ("stream": true or "ndjson") or server-sent events ("stream": "sse")
+def stream_adapt(eln, experiment_id, data):
+    events = queue.SimpleQueue()
+    # the session is acquired before the stream starts, so a busy pool is still answered with http 503
+    try:
+        smw_api = smw_session_pool.acquire()
+    except SessionPoolTimeoutError as e:
+        return session_pool_busy(e)
+
+    def run():
+        try:
+            adapter = Adapter(config, smw_api, page_callback=lambda page: events.put(('page', page)),
+                              include_page_bodies=data.get('page_bodies', True))
+            events.put(('result', adapter.adapt(eln, experiment_id, data.get('timings', False))))
+        except Exception as e:
+            events.put(('error', {'error': str(e)}))
+        finally:
+            smw_session_pool.release(smw_api)
+        events.put(None)
+
+    threading.Thread(target=run, daemon=True).start()
+    sse = data.get('stream') == 'sse'
+
+    def results():
+        while True:
+            event = events.get()
+            if event is None:
+                return
+            name, payload = event
+            if sse:
+                yield 'event: {}\ndata: {}\n\n'.format(name, json.dumps(payload))
+            else:
+                yield json.dumps(dict(payload, event=name)) + '\n'
+
+    return Response(results(), mimetype='text/event-stream' if sse else 'application/x-ndjson')
+
+# Adapts a list of ids and/or all experiments found with an ELN search query,
+# one JSON line per experiment is streamed back as soon as it is done
+@app.route('/adapt/bulk', methods=['POST'])
+def adapt_bulk():
+    data = request.get_json()
+    eln = data['eln']
+    experiment_ids = data.get('ids', [])
+    query = data.get('query')
+
+    try:
+        smw_api = smw_session_pool.acquire()
+    except SessionPoolTimeoutError as e:
+        return session_pool_busy(e)
+
+    def results():
+        adapter = Adapter(config, smw_api, include_page_bodies=data.get('page_bodies', True))
+        for result in adapter.adapt_bulk(eln, experiment_ids, query, data.get('timings', False)):
+            yield json.dumps(result) + '\n'
+
+    response = Response(stream_with_context(results()), mimetype='application/x-ndjson')
+    # released when the response is closed, also if the client disconnects before the first line
+    response.call_on_close(lambda: smw_session_pool.release(smw_api))
+    return response
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify(error='Unknown job {}'.format(job_id)), 404
+    return jsonify(job)
+
+# Counters and latency histograms per plugin and SMW api action in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/test', methods=['POST'])
 def test():
     return jsonify(success=True)
 
+# Development server, in production the app is served by gunicorn with the settings of the [Server] section:
+# gunicorn -c gunicorn.conf.py
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
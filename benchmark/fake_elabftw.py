@@ -0,0 +1,101 @@
+import json
+import random
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PROTOCOL_TYPES = ('HT', 'TT', 'INF', 'ZV')
+
+# Returns an experiment body with the given number of protocol tables like the eLabFTW templates used at the institute:
+# parameter/value tables, some with a comment column and some parameters excluded in the config
+def create_experiment_body(table_count, seed=0):
+    generator = random.Random(seed)
+    parts = ['<h1>Experiment {}</h1>'.format(seed)]
+    for i in range(table_count):
+        comment_column = i % 3 == 0
+        rows = [
+            ('Probe', 'SP-{}-{}'.format(seed, i)),
+            ('Experimentator', generator.choice(['A. Meyer', 'B. Schulz', 'C. Wagner'])),
+            ('Datum und Uhrzeit', '{:02}.{:02}.2024 {:02}:{:02}'.format(generator.randint(1, 28), generator.randint(1, 12), generator.randint(0, 23), generator.randint(0, 59))),
+            ('Experiment', generator.choice(PROTOCOL_TYPES)),
+            ('Temperatur, °C', str(generator.randint(20, 1200))),
+            ('Dauer', '{} min'.format(generator.randint(1, 600))),
+            ('Druck, MPa', '{:.2f}'.format(generator.uniform(0.1, 50))),
+            ('Ordnername Rohdaten', 'raw/{}/{}'.format(seed, i)),
+        ]
+        rows += [('Messwert {}'.format(j), '{:.3f} mm'.format(generator.uniform(0, 10))) for j in range(generator.randint(0, 12))]
+
+        html = ['<p>Protocol {}</p><table><tbody>'.format(i)]
+        if comment_column:
+            html.append('<tr><td>Parameter</td><td>Value</td><td>Comments</td></tr>')
+        for key, value in rows:
+            comment = '<td>{}</td>'.format(generator.choice(['', 'ok', 'repeated'])) if comment_column else ''
+            html.append('<tr><td>{}</td><td>{}</td>{}</tr>'.format(key, value, comment))
+        html.append('</tbody></table>')
+        parts.append(''.join(html))
+    return ''.join(parts)
+
+# In-process stand-in for the eLabFTW api v2 experiments endpoint. The experiment id determines the body,
+# tables_for(id) the number of tables of the experiment.
+class FakeElabFTW:
+    def __init__(self, tables_for, latency=0.0):
+        self.tables_for = tables_for
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.bodies = {}
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.get_request_handler())
+        self.server.daemon_threads = True
+
+    @property
+    def api_url(self):
+        return 'http://127.0.0.1:{}/api/v2'.format(self.server.server_port)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_experiment(self, experiment_id):
+        with self.lock:
+            self.request_count += 1
+            if experiment_id not in self.bodies:
+                self.bodies[experiment_id] = create_experiment_body(self.tables_for(experiment_id), experiment_id)
+        return {
+            'id': experiment_id,
+            'title': 'Experiment {}'.format(experiment_id),
+            'body': self.bodies[experiment_id],
+            'created_at': '2024-06-13 15:04:03',
+            'modified_at': '2024-06-13 15:04:03',
+        }
+
+    def get_request_handler(self):
+        elabftw = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if elabftw.latency:
+                    time.sleep(elabftw.latency)
+                match = re.search(r'/experiments/(\d+)$', self.path.split('?')[0])
+                if match:
+                    status, result = 200, elabftw.get_experiment(int(match.group(1)))
+                else:
+                    status, result = 404, {'code': 404, 'message': 'Not Found', 'description': 'Unknown path'}
+                data = json.dumps(result).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return RequestHandler
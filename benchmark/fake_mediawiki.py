@@ -0,0 +1,160 @@
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from xml.etree import ElementTree
+
+# In-process stand-in for the MediaWiki/SMW api with the actions used by the adapter:
+# login, tokens, ask (Category and ProtocolType conditions), edit (incl. createonly) and import.
+# Every request waits latency seconds, error_rate is the share of requests answered with http 503.
+class FakeMediaWiki:
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.pages = {}  # title -> {'category', 'protocol_type', 'text'}
+        self.request_counts = {}  # action -> number of requests
+        self.csrf_token = 'csrf-token+\\'
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.get_request_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def api_url(self):
+        return 'http://127.0.0.1:{}/api.php'.format(self.server.server_port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_counts(self):
+        with self.lock:
+            self.request_counts = {}
+
+    def total_requests(self):
+        with self.lock:
+            return sum(self.request_counts.values())
+
+    def get_request_handler(self):
+        wiki = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self.answer(dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query)))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                content_type = self.headers.get('Content-Type', '')
+                if content_type.startswith('multipart/form-data'):
+                    message = BytesParser(policy=default_policy).parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+                    params = {part.get_param('name', header='content-disposition'): part.get_content() for part in message.iter_parts()}
+                    params = {key: value.decode('utf-8') if isinstance(value, bytes) else value for key, value in params.items()}
+                else:
+                    params = dict(urllib.parse.parse_qsl(body.decode('utf-8')))
+                self.answer(params)
+
+            def answer(self, params):
+                status, headers, result = wiki.handle(params)
+                data = json.dumps(result).encode('utf-8')
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return RequestHandler
+
+    def handle(self, params):
+        action = params.get('action')
+        if action == 'query' and params.get('meta') == 'tokens':
+            action = 'login_token' if params.get('type') == 'login' else 'token'
+        with self.lock:
+            self.request_counts[action] = self.request_counts.get(action, 0) + 1
+            failed = self.random.random() < self.error_rate
+
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            return 503, {'Retry-After': '0'}, {'error': {'code': 'unavailable'}}
+
+        if action == 'login_token':
+            return 200, {}, {'query': {'tokens': {'logintoken': 'login-token+\\'}}}
+        elif action == 'token':
+            return 200, {}, {'query': {'tokens': {'csrftoken': self.csrf_token}}}
+        elif action == 'login':
+            return 200, {}, {'login': {'result': 'Success'}}
+        elif action == 'ask':
+            return 200, {}, self.ask(params['query'])
+        elif action == 'edit':
+            return 200, {}, self.edit(params)
+        elif action == 'import':
+            return 200, {}, self.import_pages(params)
+        return 200, {}, {'error': {'code': 'badvalue', 'info': 'Unknown action {}'.format(action)}}
+
+    def ask(self, query):
+        condition, *options = query.split('|')
+        options = dict(option.split('=', 1) for option in options if '=' in option)
+        category = re.search(r'\[\[Category:([^\]]+)\]\]', condition)
+        protocol_types = re.search(r'\[\[ProtocolType::([^\]]+)\]\]', condition)
+        with self.lock:
+            titles = [title for title, page in self.pages.items()
+                      if (not category or page['category'] == category.group(1))
+                      and (not protocol_types or page['protocol_type'] in protocol_types.group(1).split('||'))]
+        titles.sort(reverse=options.get('order') == 'desc')
+        limit = int(options.get('limit', 50))
+        result = {'query': {'results': {title: {'fulltext': title, 'printouts': []} for title in titles[:limit]}}}
+        if len(titles) > limit:
+            result['query-continue-offset'] = limit
+        return result
+
+    def edit(self, params):
+        if params.get('token') != self.csrf_token:
+            return {'error': {'code': 'badtoken'}}
+        title = params['title']
+        with self.lock:
+            if params.get('createonly') and title in self.pages:
+                return {'error': {'code': 'articleexists'}}
+            self.store_page(title, params['text'])
+        return {'edit': {'result': 'Success', 'title': title}}
+
+    def import_pages(self, params):
+        if params.get('token') != self.csrf_token:
+            return {'error': {'code': 'badtoken'}}
+        root = ElementTree.fromstring(params['xml'])
+        namespace = {'export': root.tag[1:].split('}')[0]}
+        imported = []
+        with self.lock:
+            for page in root.findall('export:page', namespace):
+                title = page.find('export:title', namespace).text
+                self.store_page(title, page.find('export:revision/export:text', namespace).text or '')
+                imported.append({'ns': 0, 'title': title.replace('_', ' '), 'revisions': 1})
+        return {'import': imported}
+
+    # Called with lock held
+    def store_page(self, title, text):
+        category = re.match(r'\{\{(\w+)', text)
+        protocol_type = re.search(r'ProtocolType=([^|}]*)', text)
+        self.pages[title] = {
+            'category': category.group(1) if category else None,
+            'protocol_type': protocol_type.group(1) if protocol_type else None,
+            'text': text
+        }
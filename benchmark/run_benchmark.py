@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark.fake_mediawiki import FakeMediaWiki
+from benchmark.fake_elabftw import FakeElabFTW
+
+EXPERIMENT_ID_STEP = 100000  # experiment ids encode the number of tables: tables * step + run number
+
+# Benchmarks Adapter.adapt and the /adapt endpoint against in-process stand-ins for SMW and eLabFTW.
+# Run from the repository root, e.g.: python -m benchmark.run_benchmark --tables 1,10,100,500 --experiments 5
+def main():
+    parser = argparse.ArgumentParser(description='Offline throughput benchmark of the ELN SMW adapter.')
+    parser.add_argument('--tables', default='1,10,100,500', help='comma separated numbers of tables per experiment')
+    parser.add_argument('--experiments', type=int, default=5, help='experiments adapted per table count and mode')
+    parser.add_argument('--mode', default='adapter,http', help='adapter (Adapter.adapt) and/or http (/adapt via the Flask test client)')
+    parser.add_argument('--concurrency', type=int, default=1, help='parallel adapt calls')
+    parser.add_argument('--smw-latency', type=float, default=0.0, help='seconds added to every SMW api request')
+    parser.add_argument('--elab-latency', type=float, default=0.0, help='seconds added to every eLabFTW api request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of SMW api requests answered with http 503')
+    parser.add_argument('--setting', action='append', default=[], help='extra config value as Section.option=value, e.g. SMW.batch_records=on')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON lines')
+    args = parser.parse_args()
+
+    wiki = FakeMediaWiki(latency=args.smw_latency, error_rate=args.error_rate).start()
+    elabftw = FakeElabFTW(lambda experiment_id: experiment_id // EXPERIMENT_ID_STEP, latency=args.elab_latency).start()
+    work_dir = tempfile.mkdtemp(prefix='eln-smw-adapter-benchmark-')
+    os.environ['ELN_SMW_ADAPTER_CONFIG'] = write_config(work_dir, wiki.api_url, elabftw.api_url, args.setting)
+
+    # imported after the config path is set, app.py reads the configuration on import
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app
+        from adapter import Adapter
+
+    results = []
+    run_number = 0
+    for mode in args.mode.split(','):
+        for table_count in [int(tables) for tables in args.tables.split(',')]:
+            experiment_ids = []
+            for _ in range(args.experiments):
+                run_number += 1
+                experiment_ids.append(table_count * EXPERIMENT_ID_STEP + run_number)
+
+            if mode == 'adapter':
+                def adapt(experiment_id):
+                    with app.smw_session_pool.session() as smw_api:
+                        return Adapter(app.config, smw_api).adapt('eLabFTW', experiment_id)
+            else:
+                client = app.app.test_client()
+
+                def adapt(experiment_id):
+                    return client.post('/adapt', json={'eln': 'eLabFTW', 'id': experiment_id}).get_json()
+
+            # adapter prints are discarded, redirected once here because sys.stdout is shared by the worker threads
+            with contextlib.redirect_stdout(io.StringIO()):
+                results.append(run(mode, table_count, experiment_ids, adapt, args.concurrency, wiki))
+
+    for result in results:
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('{mode:8} tables={tables:<4} experiments={experiments:<3} {requests_per_second:8.2f} req/s  p50={p50_ms:9.1f} ms  p99={p99_ms:9.1f} ms  '
+                  'smw round-trips/experiment={smw_requests_per_experiment:7.1f}  pages={pages:<5} failed={failed:<3} peak RSS={peak_rss_mb:.1f} MB'.format(**result))
+
+    wiki.stop()
+    elabftw.stop()
+
+def run(mode, table_count, experiment_ids, adapt, concurrency, wiki):
+    wiki.reset_counts()
+    latencies = []
+    pages = 0
+    failed = 0
+
+    def timed_adapt(experiment_id):
+        start = time.perf_counter()
+        try:
+            response = adapt(experiment_id)
+            return time.perf_counter() - start, len(response['smw_pages']), None
+        except Exception as e:
+            return time.perf_counter() - start, 0, e
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for latency, page_count, error in executor.map(timed_adapt, experiment_ids):
+            latencies.append(latency)
+            pages += page_count
+            failed += 1 if error else 0
+    duration = time.perf_counter() - start
+
+    return {
+        'mode': mode,
+        'tables': table_count,
+        'experiments': len(experiment_ids),
+        'requests_per_second': len(experiment_ids) / duration,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'smw_requests_per_experiment': wiki.total_requests() / len(experiment_ids),
+        'smw_requests': dict(wiki.request_counts),
+        'pages': pages,
+        'failed': failed,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,  # kilobytes on Linux
+    }
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(percent / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+def write_config(work_dir, smw_api_url, elab_api_url, settings):
+    config_path = os.path.join(work_dir, 'config.ini')
+    config = {
+        'Main': {'version': 'benchmark'},
+        'SMW': {'api_url': smw_api_url, 'username': 'BenchmarkBot', 'password': 'benchmark'},
+        'Logging': {'directory': os.path.join(work_dir, 'log')},
+        'Sync': {'enabled': 'off'},
+        'Jobs': {'database': os.path.join(work_dir, 'jobs.sqlite')},
+        'Plugins': {'eLabFTW': 'on'},
+        'eLabFTW': {
+            'api_url': elab_api_url,
+            'api_key': 'benchmark',
+            'exclude': 'Ordnername Rohdaten,Name des Ordners,Data Location,Folder Name,Filename, Name of the file',
+            'mapping_specimen_description': 'Probe',
+            'mapping_person': 'Experimentator',
+            'mapping_date': 'Datum und Uhrzeit',
+            'mapping_experiment': 'Experiment',
+            'cache_ttl': '0',
+        },
+    }
+    for setting in settings:
+        option, value = setting.split('=', 1)
+        section, option = option.split('.', 1)
+        config.setdefault(section, {})[option] = value
+
+    with open(config_path, 'w') as config_file:
+        for section, options in config.items():
+            config_file.write('[{}]\n'.format(section))
+            for option, value in options.items():
+                config_file.write('{} = {}\n'.format(option, value))
+            config_file.write('\n')
+    return config_path
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+import argparse
+import contextlib
+import json
+import sys
+
+from adapter import Adapter, load_config
+from logger import configure_logging
+
+# Adapts many experiments from the command line, prints one JSON line per experiment
+# Example: python bulk_adapt.py eLabFTW 12 13 14
+#          python bulk_adapt.py eLabFTW --query "heat treatment"
+def main():
+    parser = argparse.ArgumentParser(description='Adapt many ELN experiments and print one JSON result per line.')
+    parser.add_argument('eln', help='name of the ELN plugin, e.g. eLabFTW')
+    parser.add_argument('ids', nargs='*', help='ids of the experiments within the ELN')
+    parser.add_argument('--query', help='adapt all experiments found with this ELN search query')
+    args = parser.parse_args()
+
+    config = load_config()
+    configure_logging(config)  # log directory and format of the [Logging] section
+
+    output = sys.stdout
+    # keep stdout for results, status output of the adapter goes to stderr
+    with contextlib.redirect_stdout(sys.stderr):
+        adapter = Adapter(config)
+        for result in adapter.adapt_bulk(args.eln, args.ids, args.query):
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+
+if __name__ == '__main__':
+    main()
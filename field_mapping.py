@@ -0,0 +1,113 @@
+import datetime
+
+# Date formats found in ELN tables, the format that matched last is tried first
+DATE_FORMATS = (
+    '%a., %d. %b. %Y, %H:%M',  # Example: Mon., 11. Dec. 2023, 14:45
+    '%a, %d %b %Y, %H:%M',  # Example: Mon, 11 Dec 2023, 14:45
+    '%Y-%m-%d %H:%M:%S',  # Example: 2024-06-13 15:04:03
+    '%d.%m.%Y %H:%M'  # Example: 24.09.2020 10:30
+)
+
+# Spellings of units in ELN tables and their canonical SI symbol, other units are kept as written
+UNIT_ALIASES = {
+    '°C': ('°C', '° C', 'degC', 'deg C', '°c', 'grad C', 'Grad C', 'C°'),
+    'K': ('K', 'kelvin', 'Kelvin'),
+    's': ('s', 'sec', 'secs', 'second', 'seconds', 'Sek', 'sek', 'Sekunden'),
+    'min': ('min', 'mins', 'minute', 'minutes', 'Min', 'Minuten'),
+    'h': ('h', 'hr', 'hrs', 'hour', 'hours', 'Std', 'std', 'Stunden'),
+    'Pa': ('Pa', 'pa'),
+    'kPa': ('kPa', 'kpa'),
+    'MPa': ('MPa', 'mpa', 'Mpa', 'N/mm²', 'N/mm2'),
+    'GPa': ('GPa', 'gpa', 'Gpa'),
+    'µm': ('µm', 'μm', 'um', 'micron'),
+    'mm': ('mm', 'MM'),
+    'g': ('g', 'gr', 'gram', 'Gramm'),
+    'kg': ('kg', 'KG', 'Kg'),
+    '%': ('%', 'percent', 'Prozent'),
+}
+
+# Remembers the date format that matched last, ELN tables of one source mostly use the same format
+class DateFormatDetector:
+    def __init__(self, formats=DATE_FORMATS, output_format='%Y-%m-%d'):
+        self.formats = formats
+        self.output_format = output_format
+        self.last_format = formats[0]
+
+    # Returns the date in the output format or None if no format matches
+    def format(self, date_string):
+        last_format = self.last_format
+        for input_format in (last_format,) + tuple(input_format for input_format in self.formats if input_format != last_format):
+            try:
+                date_object = datetime.datetime.strptime(date_string, input_format)
+            except (TypeError, ValueError):
+                continue
+            self.last_format = input_format
+            return date_object.strftime(self.output_format)
+        return None
+
+# Lookup tables built once from the mapping_<key> and exclude options of a plugin section:
+# ELN parameter -> (mapping key, priority), excluded parameters and canonical units
+class MappingEngine:
+    def __init__(self, config, section):
+        self.mapping_options = {}  # mapping key -> configured parameter list, used in warnings
+        self.mappings = {}  # mapping key -> parameters in order of priority
+        for option, value in config.items(section):
+            if option.startswith('mapping_'):
+                self.mapping_options[option[len('mapping_'):]] = value
+                self.mappings[option[len('mapping_'):]] = tuple(key.strip() for key in value.split(','))
+        self.lookup = {}  # parameter -> [(mapping key, priority)]
+        for mapping_key, keys in self.mappings.items():
+            for priority, key in enumerate(keys):
+                self.lookup.setdefault(key, []).append((mapping_key, priority))
+        self.exclude = frozenset(key.strip() for key in config.get(section, 'exclude', fallback='').split(',') if key.strip())
+        self.units = {alias: unit for unit, aliases in UNIT_ALIASES.items() for alias in aliases}
+        self.date_detector = DateFormatDetector()  # shared by parallel requests, last_format is only a hint
+
+    # Removes the mapped parameters of mapping_keys from the protocol and returns them with the remaining parameters.
+    # Returns ({mapping key: value}, {parameter: 'value unit'}, [mapping keys without parameter]), excluded parameters are dropped
+    def process(self, protocol, mapping_keys):
+        chosen = {}  # mapping key -> (priority, parameter)
+        for parameter in protocol:
+            for mapping_key, priority in self.lookup.get(parameter, ()):
+                if mapping_key in mapping_keys and (mapping_key not in chosen or priority < chosen[mapping_key][0]):
+                    chosen[mapping_key] = (priority, parameter)
+        # like reading the mapping keys one after another: a parameter configured for several mapping keys goes to the
+        # first of them, the others take their next configured parameter or are reported as missing
+        mapped = {}
+        for mapping_key in mapping_keys:
+            if mapping_key in chosen:
+                parameter = chosen[mapping_key][1]
+                if parameter not in protocol:
+                    parameter = next((key for key in self.mappings[mapping_key] if key in protocol), None)
+                if parameter is not None:
+                    mapped[mapping_key] = protocol.pop(parameter)
+
+        data = {}
+        for parameter, value in protocol.items():
+            if parameter not in self.exclude:
+                parameter, value = self.correct_unit(parameter, value)
+                data[parameter] = value
+        return mapped, data, [mapping_key for mapping_key in mapping_keys if mapping_key not in mapped]
+
+    # Returns the value of the first parameter configured for mapping_key and removes it from the protocol if remove_parameter is set,
+    # None if the protocol contains none of them
+    def get_value(self, protocol, mapping_key, remove_parameter=True):
+        for key in self.mappings.get(mapping_key, ()):
+            if key in protocol:
+                return protocol.pop(key) if remove_parameter else protocol[key]
+        return None
+
+    # Returns the date in the format YYYY-MM-DD or None if the format is unknown
+    def format_date(self, date_string):
+        return self.date_detector.format(date_string)
+
+    # Moves the unit from the parameter name ('Temperature, °C') or the value ('5 min') behind the value
+    # and replaces known spellings of the unit by its canonical symbol
+    def correct_unit(self, parameter, value):
+        unit = ''
+        if ',' in parameter:
+            parameter, unit = parameter.rsplit(',', 1)
+        if ' ' in value:
+            value, unit = value.rsplit(' ', 1)
+        unit = unit.strip()
+        return parameter, '{} {}'.format(value.strip(), self.units.get(unit, unit))
@@ -0,0 +1,16 @@
+# Production server settings, read from the [Server] section of the adapter configuration.
+# Start with: gunicorn -c gunicorn.conf.py
+from adapter import load_config
+
+adapter_config = load_config()  # not named config, gunicorn reads every module variable as setting
+
+wsgi_app = 'app:app'
+bind = adapter_config.get('Server', 'bind', fallback='127.0.0.1:5000')
+# Every worker process imports the app with its own SMW session pool and plugins,
+# page indices, metrics and jobs are shared through the databases index_database, metrics_database and [Jobs] database
+workers = adapter_config.getint('Server', 'workers', fallback=2)
+worker_class = 'gthread'
+threads = adapter_config.getint('Server', 'threads', fallback=4)  # requests handled in parallel per worker
+timeout = adapter_config.getint('Server', 'timeout', fallback=300)  # seconds a request may take, large experiments take minutes
+graceful_timeout = 30
+accesslog = '-'
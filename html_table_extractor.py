@@ -0,0 +1,176 @@
+import re
+from html.parser import HTMLParser
+
+# Whitespace normalization and missing value strings as applied by pandas.read_html
+WHITESPACE = re.compile(r'[\r\n]+|\s{2,}')
+NA_VALUES = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'n/a', 'nan', 'null'}
+# Third column headers of tables which are read as parameter/value tables despite having more than two columns
+EXTRA_COLUMN_HEADERS = ('Comments', 'Measurement')
+
+# Data rows of a table, width is the number of columns including the header rows
+class TableRows(list):
+    def __init__(self, rows, width):
+        super().__init__(rows)
+        self.width = width
+
+class Table:
+    def __init__(self):
+        self.header_rows = []  # rows of <thead> or leading rows with only <th> cells, not part of the data
+        self.rows = []
+        self.footer_rows = []
+        self.section = None
+        self.row = None
+        self.cell = None
+
+# Collects the cell texts of all tables of a html document in one pass
+class TableExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.tables = []  # in order of their start tags, nested tables included
+        self.open_tables = []
+        self.ignored_tag = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self.ignored_tag = tag
+        elif tag == 'table':
+            table = Table()
+            self.tables.append(table)
+            self.open_tables.append(table)
+        elif not self.open_tables:
+            return
+        elif tag == 'br':
+            # pandas.read_html reads line breaks as newlines, which become spaces with the whitespace normalization
+            self.handle_data('\n')
+        elif tag in ('thead', 'tbody', 'tfoot'):
+            self.close_row(self.open_tables[-1])
+            self.open_tables[-1].section = tag
+        elif tag == 'tr':
+            table = self.open_tables[-1]
+            self.close_row(table)
+            table.row = []
+        elif tag in ('td', 'th'):
+            table = self.open_tables[-1]
+            self.close_cell(table)
+            if table.row is None:
+                table.row = []
+            attrs = dict(attrs)
+            table.cell = {'text': [], 'th': tag == 'th', 'colspan': parse_span(attrs.get('colspan')), 'rowspan': parse_span(attrs.get('rowspan'))}
+
+    def handle_endtag(self, tag):
+        if tag == self.ignored_tag:
+            self.ignored_tag = None
+        elif not self.open_tables:
+            return
+        elif tag == 'table':
+            table = self.open_tables.pop()
+            self.close_row(table)
+        elif tag in ('td', 'th'):
+            self.close_cell(self.open_tables[-1])
+        elif tag == 'tr':
+            self.close_row(self.open_tables[-1])
+        elif tag in ('thead', 'tbody', 'tfoot'):
+            self.close_row(self.open_tables[-1])
+            self.open_tables[-1].section = None
+
+    def handle_data(self, data):
+        if self.ignored_tag:
+            return
+        # text of nested tables is also part of the surrounding cell
+        for table in self.open_tables:
+            if table.cell is not None:
+                table.cell['text'].append(data)
+
+    def close_cell(self, table):
+        if table.cell is not None:
+            table.row.append(table.cell)
+            table.cell = None
+
+    def close_row(self, table):
+        self.close_cell(table)
+        if table.row is None:
+            return
+        if table.section == 'thead':
+            table.header_rows.append(table.row)
+        elif table.section == 'tfoot':
+            table.footer_rows.append(table.row)
+        else:
+            table.rows.append(table.row)
+        table.row = None
+
+def parse_span(value):
+    try:
+        return max(int(value), 1)
+    except (TypeError, ValueError):
+        return 1
+
+# Expands colspan and rowspan by repeating the cell text, like pandas.read_html
+def expand_spans(rows):
+    expanded_rows = []
+    pending_rowspans = []  # (column, text, remaining rows)
+    for row in rows:
+        expanded_row = []
+        next_pending_rowspans = []
+        column = 0
+        cells = iter(row)
+        cell = next(cells, None)
+        while cell is not None or pending_rowspans:
+            if pending_rowspans and pending_rowspans[0][0] <= column:
+                _, text, remaining = pending_rowspans.pop(0)
+                expanded_row.append(text)
+                if remaining > 1:
+                    next_pending_rowspans.append((column, text, remaining - 1))
+                column += 1
+                continue
+            if cell is None:
+                break
+            text = WHITESPACE.sub(' ', ''.join(cell['text']).strip())
+            for _ in range(cell['colspan']):
+                expanded_row.append(text)
+                if cell['rowspan'] > 1:
+                    next_pending_rowspans.append((column, text, cell['rowspan'] - 1))
+                column += 1
+            cell = next(cells, None)
+        expanded_rows.append(expanded_row)
+        pending_rowspans = next_pending_rowspans
+    return expanded_rows
+
+# Returns the data rows of every table in the html document as lists of cell texts, missing values are None
+def extract_tables(html):
+    extractor = TableExtractor()
+    extractor.feed(html)
+    extractor.close()
+
+    tables = []
+    for table in extractor.tables:
+        header_rows = table.header_rows
+        rows = table.rows
+        if not header_rows:
+            # without <thead> leading rows with only <th> cells are the header
+            while rows and rows[0] and all(cell['th'] for cell in rows[0]):
+                header_rows.append(rows.pop(0))
+        data_rows = expand_spans(rows) + expand_spans(table.footer_rows)
+        width = max([len(row) for row in expand_spans(header_rows) + data_rows] or [0])
+
+        table_rows = TableRows([], width)
+        for row in data_rows:
+            row = [None if text in NA_VALUES else text for text in row]
+            if any(text is not None for text in row):  # blank rows are skipped
+                table_rows.append(row + [None] * (width - len(row)))
+        tables.append(table_rows)
+    return tables
+
+# Reads a table with parameters in the first and values in the second column as dictionary. Tables with more
+# columns are only read if the third column is a comment or measurement column, None is returned otherwise.
+# A table with two columns but only header rows is read as empty dictionary, like pandas.read_html did.
+def table_to_dict(rows):
+    width = rows.width if isinstance(rows, TableRows) else len(rows[0]) if rows else 0
+    if width < 2:
+        return None
+    if width > 2:
+        if not rows or rows[0][2] not in EXTRA_COLUMN_HEADERS:
+            return None
+        rows = rows[1:]
+
+    # Filter out rows where key or value is empty
+    return {row[0]: row[1] for row in rows if row[0] is not None and row[1] is not None}
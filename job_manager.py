@@ -0,0 +1,150 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from adapter import Adapter
+
+class Job:
+    def __init__(self, eln, experiment_id, timings, include_page_bodies=True):
+        self.id = uuid.uuid4().hex
+        self.eln = eln
+        self.experiment_id = experiment_id
+        self.timings = timings
+        self.include_page_bodies = include_page_bodies  # if not set, the result lists the pages without their content
+        self.key = '{}:{}'.format(eln.lower(), experiment_id)  # jobs with the same key are not run twice at the same time
+
+# Status, progress and results of the jobs of all worker processes, so /jobs/<job_id> can be answered by any worker
+class JobStore:
+    instances = {}  # one store per database file and process
+    instances_lock = threading.Lock()
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # autocommit mode, transactions are started explicitly with BEGIN IMMEDIATE to lock the database for writing
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                job_key TEXT NOT NULL,
+                eln TEXT NOT NULL,
+                experiment_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                smw_pages_written TEXT,
+                messages TEXT,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                finished_at REAL)''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS jobs_in_flight ON jobs (job_key, status)')
+
+    # Returns the store configured with [Jobs] database
+    @staticmethod
+    def from_config(config):
+        path = config.get('Jobs', 'database', fallback='data/jobs.sqlite')
+        if not os.path.isabs(path):
+            path = os.path.join(os.path.dirname(__file__), path)
+        with JobStore.instances_lock:
+            if path not in JobStore.instances:
+                JobStore.instances[path] = JobStore(path)
+            return JobStore.instances[path]
+
+    # Adds the job unless a job with the same key is queued or running in any worker for less than max_runtime seconds.
+    # Returns the id of the added or the running job and whether the job was added
+    def add(self, job, max_runtime):
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                running_job = self.connection.execute("SELECT job_id FROM jobs WHERE job_key = ? AND status IN ('queued', 'running') AND created_at > ?",
+                                                      (job.key, time.time() - max_runtime)).fetchone()
+                if running_job is None:
+                    self.connection.execute("INSERT INTO jobs (job_id, job_key, eln, experiment_id, status, created_at) VALUES (?, ?, ?, ?, 'queued', ?)",
+                                            (job.id, job.key, job.eln, json.dumps(job.experiment_id), time.time()))
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+        return (job.id, True) if running_job is None else (running_job['job_id'], False)
+
+    # Sets status and progress of a job, values other than status and error are stored as JSON
+    def update(self, job_id, status, **values):
+        columns = {'status': status}
+        for column, value in values.items():
+            columns[column] = value if column == 'error' else json.dumps(value)
+        if status in ('finished', 'failed'):
+            columns['finished_at'] = time.time()
+        with self.lock:
+            self.connection.execute('UPDATE jobs SET {} WHERE job_id = ?'.format(', '.join('{} = ?'.format(column) for column in columns)),
+                                    list(columns.values()) + [job_id])
+
+    # Returns the job as dictionary for the /jobs response or None if it is unknown
+    def get(self, job_id):
+        with self.lock:
+            row = self.connection.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = {'job_id': row['job_id'], 'eln': row['eln'], 'id': json.loads(row['experiment_id']), 'status': row['status']}
+        if row['smw_pages_written'] is not None:
+            job['smw_pages_written'] = json.loads(row['smw_pages_written'])
+            job['messages'] = json.loads(row['messages'])
+        if row['result'] is not None:
+            job['result'] = json.loads(row['result'])
+        if row['error']:
+            job['error'] = row['error']
+        return job
+
+    def remove_expired_jobs(self, retention):
+        with self.lock:
+            self.connection.execute('DELETE FROM jobs WHERE finished_at < ?', (time.time() - retention,))
+
+# Runs adapt calls in a bounded pool of background workers. A job for an experiment which is already
+# queued or running (in any worker process) is not started twice, the running job is returned instead.
+class JobManager:
+    def __init__(self, config, smw_session_pool):
+        self.config = config
+        self.smw_session_pool = smw_session_pool
+        self.executor = ThreadPoolExecutor(max_workers=config.getint('Jobs', 'max_workers', fallback=2))
+        self.retention = config.getint('Jobs', 'retention', fallback=3600)  # seconds finished jobs can be polled
+        self.max_runtime = config.getint('Jobs', 'max_runtime', fallback=3600)  # jobs running longer, e.g. of a killed worker, no longer block new jobs
+        self.store = JobStore.from_config(config)
+
+    # Returns the added job or the job already running for the experiment as dictionary
+    def submit(self, eln, experiment_id, timings=False, include_page_bodies=True):
+        self.store.remove_expired_jobs(self.retention)
+        job = Job(eln, experiment_id, timings, include_page_bodies)
+        job_id, added = self.store.add(job, self.max_runtime)
+        if added:
+            self.executor.submit(self.run, job)
+        return self.store.get(job_id)
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def run(self, job):
+        adapter = None
+        try:
+            # waits at most [SMW] pool_timeout for a session, the job fails with that error otherwise
+            with self.smw_session_pool.session() as smw_api:
+                # progress is stored after each page, so it can be polled from other workers
+                adapter = Adapter(self.config, smw_api, request_id=job.id, page_callback=lambda page: self.store_progress(job, adapter),
+                                  include_page_bodies=job.include_page_bodies)
+                self.store_progress(job, adapter)
+                result = adapter.adapt(job.eln, job.experiment_id, job.timings)
+            self.store.update(job.id, 'finished', smw_pages_written=list(adapter.smw_pages), messages=list(adapter.messages), result=result)
+        except Exception as e:
+            if adapter:
+                adapter.logger.log_message('error', 'Job {} failed: {}'.format(job.id, e))
+                self.store.update(job.id, 'failed', smw_pages_written=list(adapter.smw_pages), messages=list(adapter.messages), error=str(e))
+            else:
+                self.store.update(job.id, 'failed', error=str(e))
+
+    def store_progress(self, job, adapter):
+        self.store.update(job.id, 'running', smw_pages_written=list(adapter.smw_pages), messages=list(adapter.messages))
@@ -1,33 +1,92 @@
 import os
+import atexit
+import json
+import queue
+import threading
+import uuid
 from datetime import datetime
 import logging
+from logging.handlers import QueueHandler, QueueListener
 
-class Logger:
-    def __init__(self, log_dir="log"):
-        self.start_time = datetime.now()  # Record the creation time of the logger instance
+log_listener = None  # background thread writing the queued log records, started once per process
+log_listener_lock = threading.Lock()
+
+# Writes to a log file named by the current date and switches to a new file after midnight.
+# Only used by the queue listener thread, so the file is never reopened concurrently.
+class DailyFileHandler(logging.FileHandler):
+    def __init__(self, log_dir):
         self.log_dir = log_dir
+        self.log_date = datetime.now().strftime("%Y-%m-%d")
+        super().__init__(self.get_log_path())
+
+    def get_log_path(self):
+        return os.path.join(self.log_dir, self.log_date + ".log")  # Use the current date for the log filename
+
+    def emit(self, record):
+        log_date = datetime.now().strftime("%Y-%m-%d")
+        if log_date != self.log_date:
+            self.log_date = log_date
+            self.close()
+            self.baseFilename = os.path.abspath(self.get_log_path())  # reopened by the next emit
+        super().emit(record)
+
+# Sets the request id of records logged without a request id, e.g. by libraries
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        if not hasattr(record, 'request_id'):
+            record.request_id = '-'
+        return True
+
+# Formats records as one JSON object per line
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps({
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'request_id': record.request_id,
+            'message': record.getMessage()
+        })
+
+# Sets up the 'app' logger once per process: records are put into a queue and written to the log file by a
+# background thread. Log directory and format (text or json) can be set in the [Logging] section.
+def configure_logging(config=None, log_dir="log"):
+    global log_listener
+    with log_listener_lock:
+        if log_listener is not None:
+            return
+
+        log_format = 'text'
+        if config is not None:
+            log_dir = config.get('Logging', 'directory', fallback=log_dir)
+            log_format = config.get('Logging', 'format', fallback=log_format)
 
         # Create the log directory if it doesn't exist
         if not os.path.exists(log_dir):
             os.makedirs(log_dir)
 
-        # Set up the logger
-        self.logger = logging.getLogger('app')
-        self.logger.setLevel(logging.INFO)  # Default log level is INFO
-        self.update_log_file()  # Initialize the log file
+        file_handler = DailyFileHandler(log_dir)
+        file_handler.addFilter(RequestIdFilter())
+        if log_format == 'json':
+            file_handler.setFormatter(JsonFormatter())
+        else:
+            file_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] [%(request_id)s]: %(message)s"))
 
-    def update_log_file(self):
-        log_filename = datetime.now().strftime("%Y-%m-%d.log")  # Use the current date for the log filename
-        log_path = os.path.join(self.log_dir, log_filename)
+        log_queue = queue.SimpleQueue()
+        logger = logging.getLogger('app')
+        logger.setLevel(logging.INFO)  # Default log level is INFO
+        logger.handlers.clear()
+        logger.addHandler(QueueHandler(log_queue))
 
-        # Remove existing handlers before adding a new one
-        if self.logger.handlers:
-            self.logger.handlers.clear()
+        log_listener = QueueListener(log_queue, file_handler)
+        log_listener.start()
+        atexit.register(log_listener.stop)  # write remaining records on shutdown
 
-        # Add a file handler to the logger
-        file_handler = logging.FileHandler(log_path)
-        file_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s]: %(message)s"))
-        self.logger.addHandler(file_handler)
+class Logger:
+    def __init__(self, log_dir="log", request_id=None):
+        self.start_time = datetime.now()  # Record the creation time of the logger instance
+        self.request_id = request_id or uuid.uuid4().hex[:12]  # added to every line logged by this instance
+        configure_logging(log_dir=log_dir)  # no-op if logging was already configured
+        self.logger = logging.LoggerAdapter(logging.getLogger('app'), {'request_id': self.request_id})
 
     def log_message(self, level, message):
         # Dynamically get the logging method corresponding to the level
@@ -0,0 +1,178 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the latency histogram buckets
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRIC_HELP = {
+    'adapter_runs_total': ('counter', 'Adapt runs per plugin'),
+    'adapter_run_duration_seconds': ('histogram', 'Duration of adapt runs per plugin'),
+    'adapter_stage_duration_seconds': ('histogram', 'Duration of adapt stages (fetch, parse, index_allocation, SMW api actions) per plugin'),
+    'smw_api_requests_total': ('counter', 'Requests to the SMW api per action and outcome'),
+    'smw_api_request_duration_seconds': ('histogram', 'Duration of SMW api requests per action'),
+    'smw_api_errors_total': ('counter', 'Error codes returned by the SMW api per action'),
+    'plugin_import_duration_seconds': ('histogram', 'Time to import and instantiate a plugin per plugin'),
+    'backend_retries_total': ('counter', 'Requests to a backend host retried after a transient failure'),
+    'backend_rejected_requests_total': ('counter', 'Requests failed fast per backend host because its circuit was open or all request slots were busy'),
+    'backend_circuit_opened_total': ('counter', 'Times the circuit of a backend host was opened'),
+}
+
+# Counters and histograms of all processes using the database file, e.g. the gunicorn workers. Every process writes
+# its own totals, /metrics adds them up, so any worker answers a scrape with the same monotonic values.
+# Rows of stopped workers are kept, otherwise their counts would be lost and the counters would go back.
+class SqliteMetricsStore:
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS metric_values (
+                process TEXT NOT NULL,
+                name TEXT NOT NULL,
+                labels TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (process, name, labels, kind))''')
+
+    # Stores the current totals of the given counters and histograms of a process, values are stored as JSON
+    def write(self, process, counters, histograms):
+        rows = [(process, name, json.dumps(labels), 'counter', json.dumps(value)) for (name, labels), value in counters.items()]
+        rows += [(process, name, json.dumps(labels), 'histogram', json.dumps(value)) for (name, labels), value in histograms.items()]
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO metric_values VALUES (?, ?, ?, ?, ?)', rows)
+
+    # Returns the counters and histograms added up over all processes
+    def read(self):
+        with self.lock:
+            rows = self.connection.execute('SELECT name, labels, kind, value FROM metric_values').fetchall()
+        counters = {}
+        histograms = {}
+        for name, labels, kind, value in rows:
+            key = (name, tuple(tuple(label) for label in json.loads(labels)))
+            value = json.loads(value)
+            if kind == 'counter':
+                counters[key] = counters.get(key, 0) + value
+            else:
+                histogram = histograms.setdefault(key, [[0] * len(HISTOGRAM_BUCKETS), 0.0, 0])
+                histogram[0] = [total + bucket_count for total, bucket_count in zip(histogram[0], value[0])]
+                histogram[1] += value[1]
+                histogram[2] += value[2]
+        return counters, histograms
+
+# Process-wide counters and histograms, rendered in the Prometheus text format by /metrics.
+# With a metrics database (see share) the values of all worker processes are rendered.
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [count per bucket, sum, count]
+        self.changed_keys = set()  # (name, labels) changed since the last write to the store
+        self.store = None
+        self.process = None  # key of this process in the store
+
+    # Shares the values through the database [Server] metrics_database, written every metrics_interval seconds
+    # and before each render. Without the option only the values of this process are rendered.
+    def share(self, config):
+        path = config.get('Server', 'metrics_database', fallback=None)
+        if not path or self.store is not None:
+            return
+        if not os.path.isabs(path):
+            path = os.path.join(os.path.dirname(__file__), path)
+        # set in the worker, the registry itself is created before gunicorn forks the workers. Pids are reused after restarts
+        self.process = '{}-{}'.format(os.getpid(), uuid.uuid4().hex[:8])
+        self.store = SqliteMetricsStore(path)
+        interval = config.getfloat('Server', 'metrics_interval', fallback=5)
+        threading.Thread(target=self.write_periodically, args=(interval,), daemon=True).start()
+        atexit.register(self.write)
+
+    def write_periodically(self, interval):
+        while True:
+            time.sleep(interval)
+            self.write()
+
+    # Writes the values changed since the last call to the store
+    def write(self):
+        with self.lock:
+            counters = {key: self.counters[key] for key in self.changed_keys if key in self.counters}
+            histograms = {key: [list(self.histograms[key][0])] + self.histograms[key][1:] for key in self.changed_keys if key in self.histograms}
+            self.changed_keys = set()
+        if counters or histograms:
+            self.store.write(self.process, counters, histograms)
+
+    def increment(self, name, labels=None, value=1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            self.changed_keys.add(key)
+
+    def observe(self, name, value, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [[0] * len(HISTOGRAM_BUCKETS), 0.0, 0])
+            for i, bucket in enumerate(HISTOGRAM_BUCKETS):
+                if value <= bucket:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+            self.changed_keys.add(key)
+
+    def render(self):
+        if self.store is not None:
+            self.write()
+            counters, histograms = self.store.read()
+        else:
+            with self.lock:
+                counters = dict(self.counters)
+                histograms = {key: [list(histogram[0])] + histogram[1:] for key, histogram in self.histograms.items()}
+
+        lines = []
+        names = sorted({name for name, _ in counters} | {name for name, _ in histograms})
+        for name in names:
+            metric_type, help_text = METRIC_HELP.get(name, ('untyped', name))
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for (counter_name, labels), value in sorted(counters.items()):
+                if counter_name == name:
+                    lines.append('{}{} {}'.format(name, format_labels(labels), value))
+            for (histogram_name, labels), (bucket_counts, total, count) in sorted(histograms.items()):
+                if histogram_name == name:
+                    for bucket, bucket_count in zip(HISTOGRAM_BUCKETS, bucket_counts):
+                        lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', str(bucket)),)), bucket_count))
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', '+Inf'),)), count))
+                    lines.append('{}_sum{} {}'.format(name, format_labels(labels), total))
+                    lines.append('{}_count{} {}'.format(name, format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels) + '}'
+
+registry = MetricsRegistry()
+
+# Collects the timing spans of one adapt run and adds them to the process-wide histograms
+class StageTimer:
+    def __init__(self):
+        self.plugin = ''
+        self.spans = []  # list of {'stage', 'duration_ms', ...} in order of completion
+
+    @contextmanager
+    def span(self, stage, **details):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(stage, time.perf_counter() - start, **details)
+
+    def add_span(self, stage, duration, **details):
+        self.spans.append(dict({'stage': stage, 'duration_ms': round(duration * 1000, 3)}, **details))
+        registry.observe('adapter_stage_duration_seconds', duration, {'stage': stage, 'plugin': self.plugin})
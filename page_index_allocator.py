@@ -0,0 +1,104 @@
+import os
+import re
+import sqlite3
+import threading
+
+# Raised if the highest index could not be fetched from the wiki, numbering pages without it would reuse taken titles
+class PageIndexError(Exception):
+    pass
+
+# Highest index handed out per ask condition by all allocators of this process
+class MemoryIndexStore:
+    def __init__(self):
+        self.reserved_indices = {}
+        self.lock = threading.Lock()
+
+    def synchronize(self, ask_condition, highest_index):
+        with self.lock:
+            self.reserved_indices[ask_condition] = max(self.reserved_indices.get(ask_condition, 0), highest_index)
+
+    def next_index(self, ask_condition):
+        with self.lock:
+            index = self.reserved_indices[ask_condition] + 1
+            self.reserved_indices[ask_condition] = index
+            return index
+
+# Highest index handed out per ask condition by all processes using the database file, e.g. the gunicorn workers.
+# Each index is counted up in its own write transaction, so two workers never get the same index.
+class SqliteIndexStore:
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # autocommit mode, transactions are started explicitly with BEGIN IMMEDIATE to lock the database for writing
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS page_indices (
+                ask_condition TEXT PRIMARY KEY,
+                reserved_index INTEGER NOT NULL)''')
+
+    def synchronize(self, ask_condition, highest_index):
+        with self.lock:
+            self.connection.execute('''INSERT INTO page_indices VALUES (?, ?) ON CONFLICT (ask_condition)
+                DO UPDATE SET reserved_index = MAX(reserved_index, excluded.reserved_index)''', (ask_condition, highest_index))
+
+    def next_index(self, ask_condition):
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.connection.execute('UPDATE page_indices SET reserved_index = reserved_index + 1 WHERE ask_condition = ?', (ask_condition,))
+                index = self.connection.execute('SELECT reserved_index FROM page_indices WHERE ask_condition = ?', (ask_condition,)).fetchone()[0]
+                self.connection.execute('COMMIT')
+                return index
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+# Hands out consecutive page indices per ask condition, e.g. all Specimen or all Protocols of one ProtocolType.
+# The highest index is fetched from the wiki once per condition and run, further indices are counted up locally,
+# in a database shared by all worker processes if [Server] index_database is set.
+class PageIndexAllocator:
+    stores = {}  # database path (None for the in-process store) -> store, shared by all allocators of this process
+    stores_lock = threading.Lock()
+
+    def __init__(self, smw_api, config=None):
+        self.smw_api = smw_api
+        self.store = PageIndexAllocator.get_store(config)
+        self.synchronized_conditions = set()  # Conditions whose highest index was fetched from the wiki in this run
+
+    @staticmethod
+    def get_store(config):
+        path = config.get('Server', 'index_database', fallback=None) if config is not None else None
+        if path and not os.path.isabs(path):
+            path = os.path.join(os.path.dirname(__file__), path)
+        with PageIndexAllocator.stores_lock:
+            if path not in PageIndexAllocator.stores:
+                PageIndexAllocator.stores[path] = SqliteIndexStore(path) if path else MemoryIndexStore()
+            return PageIndexAllocator.stores[path]
+
+    def next_index(self, ask_condition):
+        if ask_condition not in self.synchronized_conditions:
+            self.synchronize(ask_condition, self.query_highest_index(ask_condition))
+        return self.store.next_index(ask_condition)
+
+    # Takes over the highest index found on the wiki unless a higher one has already been handed out
+    def synchronize(self, ask_condition, highest_index):
+        self.store.synchronize(ask_condition, highest_index)
+        self.synchronized_conditions.add(ask_condition)
+
+    # Forces a new query for the condition, e.g. after a page title was taken by another process
+    def invalidate(self, ask_condition):
+        self.synchronized_conditions.discard(ask_condition)
+
+    def query_highest_index(self, ask_condition):
+        data = self.smw_api.ask('{}|limit=1|order=desc'.format(ask_condition))
+        if not data or 'query' not in data:
+            raise PageIndexError('Highest page index for {} could not be queried from the wiki'.format(ask_condition))
+        if data["query"]["results"]:
+            page_name = next(iter(data["query"]["results"].values()))['fulltext']
+            page_name_number = re.search(r'(\d+)$', page_name).group(0)
+            return int(page_name_number)
+        else:
+            return 0
@@ -0,0 +1,119 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class PageWriteTask:
+    def __init__(self, category, data, title_fields, sync_key):
+        self.category = category
+        self.data = data
+        self.sync_key = sync_key
+        self.title_fields = title_fields  # data keys which are filled with the final title of another task
+        self.title = None
+        self.waiting_for = 0  # number of dependencies not written yet
+        self.dependents = []
+
+# Writes SMW pages in parallel. Titles are allocated when a page is added, a page is written as soon as all
+# pages whose titles it contains are written, independent pages are written concurrently.
+class PageWriteScheduler:
+    def __init__(self, adapter):
+        self.adapter = adapter
+        self.max_workers = adapter.config.getint('SMW', 'max_parallel_edits', fallback=4)
+        # with batch_records Record pages are collected and written with one import request per batch
+        self.batch_categories = ('Record',) if adapter.config.getboolean('SMW', 'batch_records', fallback=False) else ()
+        self.batch_size = adapter.config.getint('SMW', 'batch_size', fallback=50)
+        self.tasks = []
+        self.batched_tasks = []  # ready tasks waiting to be written in a batch
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.remaining_tasks = 0
+        self.errors = []
+        self.executor = None
+
+    # Adds a page, title_fields maps data keys to tasks, e.g. {'Protocol': protocol_task}. See Adapter.create_smw_page for sync_key
+    def add(self, category, data, title_fields=None, sync_key=None):
+        task = PageWriteTask(category, data, title_fields or {}, sync_key)
+        for key, dependency in task.title_fields.items():
+            data[key] = dependency.title
+        for dependency in set(task.title_fields.values()):
+            dependency.dependents.append(task)
+            task.waiting_for += 1
+        task.title = self.adapter.new_smw_page_title(category, data, sync_key)
+        self.tasks.append(task)
+        return task
+
+    def run(self):
+        if not self.tasks:
+            return
+        self.remaining_tasks = len(self.tasks)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            self.executor = executor
+            with self.lock:
+                for task in self.tasks:
+                    if task.waiting_for == 0:
+                        self.schedule(task)
+                self.submit_batches()
+            self.finished.wait()
+
+        # keep the order in which pages were added for the response
+        written_pages = {task.title: self.adapter.smw_pages.pop(task.title) for task in self.tasks if task.title in self.adapter.smw_pages}
+        self.adapter.smw_pages.update(written_pages)
+
+        if self.errors:
+            raise self.errors[0]
+
+    # Called with lock held
+    def schedule(self, task):
+        if task.category in self.batch_categories:
+            self.batched_tasks.append(task)
+        else:
+            self.executor.submit(self.execute, task)
+
+    # Called with lock held, batches are written once all other pages are written
+    def submit_batches(self):
+        if not self.batched_tasks or self.remaining_tasks > len(self.batched_tasks):
+            return
+        for i in range(0, len(self.batched_tasks), self.batch_size):
+            self.executor.submit(self.execute_batch, self.batched_tasks[i:i + self.batch_size])
+        self.batched_tasks = []
+
+    # titles of dependencies may have changed if their allocated title was taken in the meantime
+    def update_titles(self, task):
+        titles_changed = False
+        for key, dependency in task.title_fields.items():
+            titles_changed = titles_changed or task.data[key] != dependency.title
+            task.data[key] = dependency.title
+        if titles_changed and not self.adapter.get_smw_page_numbering(task.category, task.data):
+            task.title = self.adapter.new_smw_page_title(task.category, task.data, task.sync_key)
+
+    def execute(self, task):
+        try:
+            self.update_titles(task)
+            task.title = self.adapter.write_smw_page(task.category, task.data, task.title, task.sync_key)
+        except Exception as e:
+            self.adapter.logger.log_message('error', 'Writing page {} failed: {}'.format(task.title, e))
+            self.errors.append(e)
+        finally:
+            self.complete([task])
+
+    def execute_batch(self, tasks):
+        try:
+            for task in tasks:
+                self.update_titles(task)
+            for category in dict.fromkeys(task.category for task in tasks):
+                self.adapter.write_smw_pages_batch(category, [(task.data, task.title, task.sync_key) for task in tasks if task.category == category])
+        except Exception as e:
+            self.adapter.logger.log_message('error', 'Writing pages {} failed: {}'.format(', '.join(task.title for task in tasks), e))
+            self.errors.append(e)
+        finally:
+            self.complete(tasks)
+
+    def complete(self, tasks):
+        with self.lock:
+            for task in tasks:
+                for dependent in task.dependents:
+                    dependent.waiting_for -= 1
+                    if dependent.waiting_for == 0:
+                        self.schedule(dependent)
+                self.remaining_tasks -= 1
+            self.submit_batches()
+            if self.remaining_tasks == 0:
+                self.finished.set()
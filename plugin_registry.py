@@ -0,0 +1,61 @@
+import copy
+import importlib
+import threading
+import time
+
+import metrics
+from logger import Logger
+
+# Plugins enabled in the [Plugins] section. Only their names and modules are registered when the registry is created,
+# a plugin is imported and instantiated once per process on its first request or by warm_up.
+# Each request gets a shallow copy bound to its adapter, api clients and caches of the plugin are shared.
+class PluginRegistry:
+    registries = []  # one registry per configuration object
+    registries_lock = threading.Lock()
+
+    def __init__(self, config):
+        self.config = config
+        self.modules = {}  # lower case plugin name -> module name
+        for name in config.options('Plugins') if config.has_section('Plugins') else []:
+            if config.getboolean('Plugins', name):
+                self.modules[name.lower()] = 'plugins.' + name.lower()
+        self.plugins = {}  # lower case plugin name -> plugin instance, filled on first use
+        self.import_times = {}  # lower case plugin name -> seconds to import and instantiate the plugin
+        self.lock = threading.Lock()
+
+    # Returns the registry for the configuration, plugins are registered on the first call
+    @staticmethod
+    def for_config(config):
+        with PluginRegistry.registries_lock:
+            for registry in PluginRegistry.registries:
+                if registry.config is config:
+                    return registry
+            registry = PluginRegistry(config)
+            PluginRegistry.registries.append(registry)
+            return registry
+
+    # Returns the plugin for the eln bound to the adapter or None if the plugin is not enabled
+    def get(self, eln, adapter):
+        if eln.lower() not in self.modules:
+            return None
+        plugin = copy.copy(self.load(eln.lower(), adapter.logger if adapter else None))
+        plugin.adapter = adapter
+        return plugin
+
+    # Imports all enabled plugins, e.g. at startup so the first requests do not wait for the imports ([Server] warmup)
+    def warm_up(self):
+        logger = Logger(request_id='warmup')
+        for name in self.modules:
+            self.load(name, logger)
+
+    # Returns the shared plugin instance, imported with the lock held so parallel first requests import it once
+    def load(self, name, logger=None):
+        with self.lock:
+            if name not in self.plugins:
+                start = time.perf_counter()
+                self.plugins[name] = importlib.import_module(self.modules[name], '.').Plugin(self.config, None)
+                self.import_times[name] = time.perf_counter() - start
+                metrics.registry.observe('plugin_import_duration_seconds', self.import_times[name], {'plugin': name})
+                if logger:
+                    logger.log_message('info', 'Plugin {} imported in {} ms'.format(name, int(self.import_times[name] * 1000)))
+            return self.plugins[name]
@@ -1,75 +1,172 @@
 import elabapi_python
-import pandas as pd
-from bs4 import BeautifulSoup
 from elabapi_python.rest import ApiException
 import json
-
-from adapter import Adapter
-import datetime
-from io import StringIO
+import copy
+import threading
+import time
+import requests
+import urllib3
+
+from page_write_scheduler import PageWriteScheduler
+from html_table_extractor import extract_tables, table_to_dict
+from field_mapping import MappingEngine
+from resilience import ResilientHost, TransientError, TRANSIENT_HTTP_STATUS, RETRY_SAFE_HTTP_STATUS, parse_retry_after
+
+# Reads the protocols of an experiment body, runs in worker processes for bulk adapt calls.
+# Returns the number of tables found and the list of protocol dictionaries
+def parse_elab_protocols(body, keys_to_remove):
+    # Extract all tables
+    tables = extract_tables(body)
+
+    # Process tables with exactly two columns and create dictionaries
+    all_table_dicts = []
+    for table in tables:
+        # Check if the table has exactly two columns or third column is comment
+        table_dict = table_to_dict(table)
+        if table_dict is not None:
+            if not all_table_dicts or len(all_table_dicts[-1]) >= 4:
+                # Create a dictionary with left column as keys and right column as values
+
+                all_table_dicts.append(table_dict)
+            else:
+                # if previous dict has less than 4 items expect the experiment to be split in two tables and add parameters to previous dict
+                all_table_dicts[-1].update(table_dict)
+
+    # Remove items that are excluded in config
+    for dictionary in all_table_dicts:
+        for key in keys_to_remove:
+            dictionary.pop(key, None)
+
+    # Remove all with less than 4 items
+    all_table_dicts = [dictionary for dictionary in all_table_dicts if len(dictionary) >= 4]
+    return len(tables), all_table_dicts
 
 class Plugin:
     def __init__(self, config, adapter):
         self.name = 'eLabFTW'
         self.config = config
         self.adapter = adapter
+        # api client and caches are created once and shared by all requests, see PluginRegistry
+        self.experiments_api = self.create_experiments_api()
+        # Retries, concurrency cap and circuit breaker for all requests to eLabFTW, see [eLabFTW] retries
+        self.resilient_host = ResilientHost.for_url(config.get(self.name, 'api_url'), config, self.name)
+        self.timeout = config.getfloat(self.name, 'timeout', fallback=60)
+        # mapping_* and exclude options are read once, see field_mapping
+        self.mapping = MappingEngine(config, self.name)
+        self.cache_ttl = config.getint(self.name, 'cache_ttl', fallback=0)  # seconds fetched experiments are reused
+        self.experiment_cache = {}  # experiment id -> (fetch time, experiment)
+        self.protocol_cache = {}  # (experiment id, modified_at) -> parsed protocols
+        self.cache_lock = threading.Lock()
 
     def run(self, id):
         elab_experiment = self.get_elab_experiment(id)
         if elab_experiment:
-            elab_protocols = self.get_elab_protocols(elab_experiment)
-            if len(elab_protocols) == 0:
-                print(json.dumps(elab_protocols, indent=4))
-                print('test')
-                return None
-        else:
-            return None
+            self.create_pages(id, elab_experiment, self.parse_cached(id, elab_experiment))
+        return None
 
-        # extract specimen creator from first experiment table
-        specimen_person = self.get_experiment_value_with_mapping(elab_protocols[0], 'person', '')
+    # Parses the experiment body unless the same version of the experiment was parsed within cache_ttl
+    def parse_cached(self, id, elab_experiment):
+        cache_key = (str(id), getattr(elab_experiment, 'modified_at', None))
+        with self.cache_lock:
+            parsed_protocols = self.protocol_cache.get(cache_key)
+        if parsed_protocols is None:
+            parse_function, parse_arguments = self.parse_task(elab_experiment)
+            with self.adapter.timer.span('parse'):
+                parsed_protocols = parse_function(*parse_arguments)
+            if self.cache_ttl > 0:
+                with self.cache_lock:
+                    self.protocol_cache[cache_key] = parsed_protocols
+        return copy.deepcopy(parsed_protocols)  # protocols are changed while creating pages
+
+    # Functions for bulk adapt calls: experiments are fetched concurrently, parsed in worker processes
+    # with the function returned by parse_task and written with create_pages
+    def fetch(self, id):
+        return self.get_elab_experiment(id)
+
+    def parse_task(self, elab_experiment):
+        return parse_elab_protocols, (elab_experiment.body, sorted(self.mapping.exclude))
+
+    # Returns the ids of all experiments found with the eLabFTW search
+    def search(self, query):
+        try:
+            experiments = self.call_elab_api(self.get_experiments_api().read_experiments, q=query, limit=self.config.getint(self.name, 'search_limit', fallback=500))
+            return [experiment.id for experiment in experiments]
+        except ApiException as e:
+            self.adapter.logger.log_message('error', 'eLabApi search for {} returned http status {}'.format(query, e.status))
+            self.adapter.add_message('error', 'eLabApi search for {} returned http status {}'.format(query, e.status))
+            return []
+        except requests.RequestException as e:
+            self.adapter.logger.log_message('error', 'eLabApi search for {} failed: {}'.format(query, e))
+            self.adapter.add_message('error', 'eLabFTW is not available: {}'.format(e))
+            return []
+
+    def create_pages(self, id, elab_experiment, parsed_protocols):
+        elab_protocols = self.check_elab_protocols(parsed_protocols)
+        if len(elab_protocols) == 0:
+            return None
 
-        # only one specimen per eLabFTW page
+        # only one specimen per eLabFTW page, described by the first experiment table
         specimen = {}
-        specimen['Description'] = self.get_experiment_value_with_mapping(elab_protocols[0], 'specimen_description', '')
-        specimen['Person'] = specimen_person
-        specimen['Material'] = '?' #todo: extend elab template by material
-        specimen['Name'] = self.adapter.create_smw_page('Specimen', specimen)
-
         protocols = []
         records = []
         for i, elab_protocol in enumerate(elab_protocols):
+            # mapped parameters are taken out of the table, the remaining parameters are the data of the record
+            # in this order a parameter configured for several mapping keys is assigned, person comes first as before
+            mapping_keys = ('person', 'specimen_description', 'date', 'experiment') if i == 0 else ('date', 'experiment', 'person')
+            mapped, data, missing_keys = self.mapping.process(elab_protocol, mapping_keys)
+            for mapping_key in missing_keys:
+                self.add_mapping_missing_message(elab_protocol, mapping_key)
+
+            if i == 0:
+                specimen['Description'] = mapped.get('specimen_description', '')
+                specimen['Person'] = mapped.get('person', '')
+                specimen['Material'] = '?' #todo: extend elab template by material
+
             # extract date from experiment
-            date_string = self.get_experiment_value_with_mapping(elab_protocols[i], 'date', '')
-            formatted_date = Plugin.format_experiment_date(date_string)
+            date_string = mapped.get('date', '')
+            formatted_date = self.mapping.format_date(date_string)
             if not formatted_date:
-                formatted_date = Plugin.format_experiment_date(elab_experiment.created_at)
+                formatted_date = self.mapping.format_date(elab_experiment.created_at)
                 self.adapter.logger.log_message('warning', 'unable to format date: {}'.format(date_string))
 
             protocol = {}
-            protocol['ProtocolType'] = self.get_experiment_value_with_mapping(elab_protocols[i], 'experiment', 'INFELN')
+            protocol['ProtocolType'] = mapped.get('experiment', 'INFELN')
             protocol['Date'] = formatted_date
-            protocol['Person'] = self.get_experiment_value_with_mapping(elab_protocols[i], 'person', '')
-            protocol['SpecimenList'] = specimen['Name']
+            protocol['Person'] = mapped.get('person', '')
             protocol['Origin'] = self.name
             protocol['OriginInternalIdentifier'] = id
             protocols.append(protocol)
-            protocol['Name'] = self.adapter.create_smw_page('Protocol', protocol)
 
             record = {}
-            record['Specimen'] = specimen['Name']
-            record['Protocol'] = protocol['Name']
-            record['Data'] = {}
-            for parameter, value in elab_protocol.items():
-                parameter, value = Plugin.correct_unit(parameter, value)
-                record['Data'][parameter] = value
-
+            record['Data'] = data
             records.append(record)
-            record['Name'] = self.adapter.create_smw_page('Record', record)
 
-        Adapter.test(specimen, protocols, records)
+        # fetch the highest index of all protocol types at once instead of one query per protocol
+        self.adapter.reserve_smw_protocol_indices([protocol['ProtocolType'] for protocol in protocols])
 
-    def get_elab_experiment(self, experiment_id):
+        # protocols depend on the specimen name and records on their protocol name, independent pages are written in parallel
+        scheduler = PageWriteScheduler(self.adapter)
+        # pages of a previous run for the same experiment table are reused, unchanged pages are skipped
+        specimen_write = scheduler.add('Specimen', specimen, sync_key=(self.name, id, 0))
+        protocol_writes = []
+        record_writes = []
+        for position, (protocol, record) in enumerate(zip(protocols, records)):
+            protocol_writes.append(scheduler.add('Protocol', protocol, {'SpecimenList': specimen_write}, sync_key=(self.name, id, position)))
+            record_writes.append(scheduler.add('Record', record, {'Specimen': specimen_write, 'Protocol': protocol_writes[-1]}, sync_key=(self.name, id, position)))
+        scheduler.run()
+
+        specimen['Name'] = specimen_write.title
+        for protocol, protocol_write in zip(protocols, protocol_writes):
+            protocol['Name'] = protocol_write.title
+        for record, record_write in zip(records, record_writes):
+            record['Name'] = record_write.title
+
+        self.adapter.test(specimen, protocols, records)
+
+    def get_experiments_api(self):
+        return self.experiments_api
 
+    def create_experiments_api(self):
         # Configure the api client
         configuration = elabapi_python.Configuration()
         configuration.api_key['api_key'] = self.config[self.name]['api_key']
@@ -77,6 +174,7 @@ class Plugin:
         configuration.host = self.config['eLabFTW']['api_url']
         configuration.debug = False
         configuration.verify_ssl = False
+        configuration.connection_pool_maxsize = self.config.getint(self.name, 'connection_pool_maxsize', fallback=4)  # keep-alive connections shared by all requests
 
         # create an instance of the API class
         api_client = elabapi_python.ApiClient(configuration)
@@ -84,13 +182,33 @@ class Plugin:
         api_client.set_default_header(header_name='Authorization', header_value=self.config[self.name]['api_key'])
 
         # create an instance of Experiments
-        experiments_api = elabapi_python.ExperimentsApi(api_client)
+        return elabapi_python.ExperimentsApi(api_client)
+
+    def get_elab_experiment(self, experiment_id):
+        experiments_api = self.get_experiments_api()
+
+        # reuse an experiment fetched within the last cache_ttl seconds, e.g. after a double click in the ELN
+        now = time.monotonic()
+        with self.cache_lock:
+            for cached_id in [cached_id for cached_id, (fetched_at, _) in self.experiment_cache.items() if now - fetched_at > self.cache_ttl]:
+                del self.experiment_cache[cached_id]
+            cached_experiment = self.experiment_cache.get(str(experiment_id))
+            # pruned in place, the caches are shared by the plugin copies of all requests
+            for key in [key for key in self.protocol_cache if key[0] not in self.experiment_cache]:
+                del self.protocol_cache[key]
+        if cached_experiment:
+            self.adapter.logger.log_message('info', 'eLabApi experiment with id {} taken from cache'.format(experiment_id))
+            return cached_experiment[1]
 
         # get experiment with ID
         try:
-            exp = experiments_api.get_experiment(experiment_id)
+            with self.adapter.timer.span('fetch'):
+                exp = self.call_elab_api(experiments_api.get_experiment, experiment_id)
             self.adapter.logger.log_message('info', 'eLabApi call for experiment with id {} successfull'.format(experiment_id))
             self.adapter.logger.log_runtime()
+            if self.cache_ttl > 0:
+                with self.cache_lock:
+                    self.experiment_cache[str(experiment_id)] = (time.monotonic(), exp)
             return exp
         except ApiException as e:
 
@@ -99,93 +217,43 @@ class Plugin:
             self.adapter.add_message('error', 'eLabApi returned http status {} - {}'.format(error_json.get('code'), error_json.get('message')))
 
             return None
+        except requests.RequestException as e:
+            # eLabFTW is overloaded or down, see call_elab_api
+            self.adapter.logger.log_message('error', 'eLabApi call for experiment with id {} failed: {}'.format(experiment_id, e))
+            self.adapter.add_message('error', 'eLabFTW is not available: {}'.format(e))
+            return None
+
+    # Calls a function of the eLabFTW api client through the resilience layer, overload and connection errors are retried
+    def call_elab_api(self, function, *args, **kwargs):
+        def call():
+            try:
+                return function(*args, _request_timeout=self.timeout, **kwargs)
+            except ApiException as e:
+                if e.status in TRANSIENT_HTTP_STATUS:
+                    raise TransientError('eLabApi returned http status {}'.format(e.status), parse_retry_after((e.headers or {}).get('Retry-After')),
+                                         retry_safe=e.status in RETRY_SAFE_HTTP_STATUS)
+                raise
+            except urllib3.exceptions.HTTPError as e:
+                raise TransientError('eLabApi request failed: {}'.format(e))
+        return self.resilient_host.call(call)
 
     def get_elab_protocols(self, elab_experiment):
-        soup = BeautifulSoup(elab_experiment.body, 'html.parser')
+        return self.check_elab_protocols(self.parse_cached(elab_experiment.id, elab_experiment))
 
-        # Extract all tables
-        tables = soup.find_all('table')
-        if len(tables) == 0:
+    def check_elab_protocols(self, parsed_protocols):
+        table_count, elab_protocols = parsed_protocols
+        if table_count == 0:
             self.adapter.add_message('error', 'No table found on page. Protocols must be provided in a table format, with one column for parameters and another for their corresponding values.')
-
-        # Process tables with exactly two columns and create dictionaries
-        all_table_dicts = []
-        for table in tables:
-            # Wrap the HTML string in StringIO
-            table_html = str(table)
-            table_io = StringIO(table_html)
-
-            # Read the table into a DataFrame
-            dataframe = pd.read_html(table_io)[0]
-
-            # Check if the table has exactly two columns or third column is comment
-            if dataframe.shape[1] == 2 or dataframe.shape[1] > 2 and dataframe.iloc[0, 2] == 'Comments'  or dataframe.shape[1] > 2 and dataframe.iloc[0, 2] == 'Measurement':
-                if dataframe.shape[1] > 2:
-                    dataframe = dataframe.iloc[1:]
-
-                # Filter out rows where key or value is empty
-                dataframe = dataframe.dropna(subset=[dataframe.columns[0], dataframe.columns[1]])
-                dataframe = dataframe[(dataframe.iloc[:, 0] != "") & (dataframe.iloc[:, 1] != "")]
-                table_dict = dict(zip(dataframe.iloc[:, 0], dataframe.iloc[:, 1]))
-                if not all_table_dicts or len(all_table_dicts[-1]) >= 4:
-                    # Create a dictionary with left column as keys and right column as values
-
-                    all_table_dicts.append(table_dict)
-                else:
-                    # if previous dict has less than 4 items expect the experiment to be split in two tables and add parameters to previous dict
-                    all_table_dicts[-1].update(table_dict)
-
-        # Remove items that are excluded in config
-        for dictionary in all_table_dicts:
-            keys_to_remove = self.config.get(self.name, 'exclude').split(',')
-            for key in keys_to_remove:
-                dictionary.pop(key, None)
-
-        # Remove all with less than 4 items
-        all_table_dicts = [dictionary for dictionary in all_table_dicts if len(dictionary) >= 4]
-        return all_table_dicts
+        return elab_protocols
 
     def get_experiment_value_with_mapping(self, elab_protocol, mapping_key, default_value, remove_parameter=True):
-        keys = self.config.get(self.name, 'mapping_{}'.format(mapping_key))
-        key_list = keys.split(',')
-        for key in key_list:
-            key = key.strip()
-            if key in elab_protocol:
-                value = elab_protocol[key]
-                if remove_parameter:
-                    elab_protocol.pop(key)
-                return value
-
-        self.adapter.add_message('warning', 'No entry for {}. Each table must contain one of the following parameters: {}'.format(mapping_key, keys))
+        value = self.mapping.get_value(elab_protocol, mapping_key, remove_parameter)
+        if value is None:
+            self.add_mapping_missing_message(elab_protocol, mapping_key)
+            return default_value
+        return value
+
+    def add_mapping_missing_message(self, elab_protocol, mapping_key):
+        self.adapter.add_message('warning', 'No entry for {}. Each table must contain one of the following parameters: {}'.format(mapping_key, self.mapping.mapping_options.get(mapping_key, '')))
         print('no {}'.format(mapping_key))
         print(elab_protocol)
-        return default_value
-
-    @staticmethod
-    def format_experiment_date(date_string):
-        formats_to_try = [
-            '%a., %d. %b. %Y, %H:%M',  # Example: Mon., 11. Dec. 2023, 14:45
-            '%a, %d %b %Y, %H:%M',  # Example: Mon., 11. Dec. 2023, 14:45
-            '%Y-%m-%d %H:%M:%S', # Example: 2024-06-13 15:04:03
-            '%d.%m.%Y %H:%M' # Example: 24.09.2020 10:30
-        ]
-
-        output_format = '%Y-%m-%d'
-
-        for input_format in formats_to_try:
-            try:
-                date_object = datetime.datetime.strptime(date_string, input_format)
-                return date_object.strftime(output_format)
-            except ValueError:
-                continue
-        return None
-
-    @staticmethod
-    def correct_unit(parameter, value):
-        unit = ''
-        if ',' in parameter:
-            parameter, unit = parameter.rsplit(',', 1)
-        if ' ' in value:
-            value, unit = value.rsplit(' ', 1)
-        value = '{} {}'.format(value.strip(), unit.strip())
-        return parameter, value
\ No newline at end of file
@@ -1,10 +1,13 @@
-from adapter import Adapter
+# Plugins are imported on their first request (or at startup with [Server] warmup), import eln client libraries here.
+# Use the adapter passed to the plugin instead of importing adapter, which would import the plugin back
+from field_mapping import MappingEngine
 
 class Plugin:
     def __init__(self, config, adapter):
         self.name = '<plugin->'
         self.config = config
         self.adapter = adapter
+        self.mapping = MappingEngine(config, self.name) # lookup tables for the mapping_* and exclude options of the plugin section
 
     # Use this function to read experiment data from eln, transform into expected data structure and create smw pages
     def run(self, id):
@@ -14,9 +17,13 @@ class Plugin:
         identifier_within_eln = id
         source_api_token = self.config[self.name]['api_key']
 
+        # Map a table of parameters read from the eln: configured parameters are taken out, the rest becomes the record data
+        # with units in canonical form, e.g. {'Datum': '24.09.2020 10:30', 'Temperatur, degC': '900'} -> ({'date': ...}, {'Temperatur': '900 °C'}, [])
+        mapped, data, missing_keys = self.mapping.process({}, ('date', 'person'))
+
         protocol = {}
         protocol['ProtocolType'] = 'INFHTr' # Experiment: e.g. heat treatment
-        protocol['Date'] = "yyyy-MM-dd"
+        protocol['Date'] = self.mapping.format_date(mapped.get('date', '')) or "yyyy-MM-dd"
         protocol['Person'] = None
         self.adapter.add_message('warning', 'Parameter person missing in experiment. Protocols created without Experimentator.') # Add message to http response
         protocol['SpecimenList'] = 'S001,S002' # Create specimen pages beforehand and use names returned by adapter.create_smw_page()
@@ -0,0 +1,165 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+import requests
+
+import metrics
+
+# Http status codes of overloaded or restarting backends, retried for idempotent calls
+TRANSIENT_HTTP_STATUS = (429, 502, 503, 504)
+# Of these, the status codes of requests the backend rejected without processing them, retried for all calls.
+# A gateway error (502, 504) can arrive after the backend has processed the request.
+RETRY_SAFE_HTTP_STATUS = (429, 503)
+
+# Raised by the functions called through ResilientHost.call if the backend is unavailable for the moment, e.g. http 503 or maxlag.
+# retry_safe is set if the request was certainly not processed, so it can be sent again even if it is not idempotent.
+class TransientError(requests.RequestException):
+    def __init__(self, message, retry_after=None, retry_safe=False):
+        super().__init__(message)
+        self.retry_after = retry_after  # seconds the backend asked to wait, e.g. from the Retry-After header
+        self.retry_safe = retry_safe
+
+# Raised without contacting the backend while its circuit is open
+class CircuitOpenError(requests.RequestException):
+    pass
+
+# Raised if no request slot for the host became free within queue_timeout
+class HostBusyError(requests.RequestException):
+    pass
+
+# Failures which are retried for idempotent calls and counted by the circuit breaker
+TRANSIENT_ERRORS = (TransientError, requests.ConnectionError, requests.Timeout)
+# Failures of requests which certainly did not reach the backend, retried for all calls
+RETRY_SAFE_ERRORS = (requests.ConnectTimeout,)
+
+# Returns True if the failed request was certainly not processed by the backend
+def is_retry_safe(error):
+    return isinstance(error, RETRY_SAFE_ERRORS) or isinstance(error, TransientError) and error.retry_safe
+
+# Returns the seconds of a Retry-After header (delay in seconds or http date), None if missing or invalid
+def parse_retry_after(value):
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+# Fails fast after failure_threshold consecutive failures. After reset_timeout seconds one request is let through,
+# the circuit is closed again if it succeeds.
+class CircuitBreaker:
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0  # consecutive failures
+        self.opened_at = None  # monotonic time the circuit was opened, None while closed
+        self.probing = False  # a trial request is running while the circuit is open
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.probing = True
+            return True
+
+    # Ends a trial request without result, the next request is let through
+    def cancel(self):
+        with self.lock:
+            self.probing = False
+
+    # Returns True if the circuit was opened by this failure
+    def record(self, failed):
+        with self.lock:
+            was_probing = self.probing
+            self.probing = False
+            if not failed:
+                self.failures = 0
+                self.opened_at = None
+                return False
+            self.failures += 1
+            if was_probing or (self.opened_at is None and self.failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+# Retries, concurrency cap and circuit breaker for all requests of this process to one backend host.
+# Settings are read from the config section of the backend, e.g. [SMW] or [eLabFTW].
+class ResilientHost:
+    hosts = {}  # host name -> ResilientHost, shared by all sessions and api clients of this process
+    hosts_lock = threading.Lock()
+
+    def __init__(self, host, config, section):
+        self.host = host
+        self.retries = config.getint(section, 'retries', fallback=3)
+        self.retry_base_delay = config.getfloat(section, 'retry_base_delay', fallback=0.5)
+        self.retry_max_delay = config.getfloat(section, 'retry_max_delay', fallback=10)
+        self.queue_timeout = config.getfloat(section, 'queue_timeout', fallback=30)
+        self.slots = threading.BoundedSemaphore(config.getint(section, 'max_concurrent_requests', fallback=8))
+        self.circuit_breaker = CircuitBreaker(config.getint(section, 'circuit_failure_threshold', fallback=5),
+                                              config.getfloat(section, 'circuit_reset_timeout', fallback=30))
+
+    # Returns the ResilientHost of the url's host, created with the settings of section on first use
+    @staticmethod
+    def for_url(url, config, section):
+        host = urlparse(url).netloc
+        with ResilientHost.hosts_lock:
+            if host not in ResilientHost.hosts:
+                ResilientHost.hosts[host] = ResilientHost(host, config, section)
+            return ResilientHost.hosts[host]
+
+    # Calls function and returns its result. Transient failures are retried with jittered exponential backoff,
+    # calls which must not be sent twice (idempotent=False) are only retried if the backend did not process them.
+    def call(self, function, idempotent=True):
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                result = function()
+            except Exception as e:
+                transient = isinstance(e, TRANSIENT_ERRORS)
+                self.release(failed=transient)
+                if not transient or not (idempotent or is_retry_safe(e)) or attempt >= self.retries:
+                    raise
+                delay = self.get_retry_delay(attempt, getattr(e, 'retry_after', None))
+                if delay is None:
+                    raise  # waiting as long as the backend asks for would block the worker for too long
+                attempt += 1
+                metrics.registry.increment('backend_retries_total', {'host': self.host})
+                print(f"Request to {self.host} failed ({e}), retry {attempt} in {delay:.1f} s.")
+                time.sleep(delay)
+                continue
+            self.release(failed=False)
+            return result
+
+    def acquire(self):
+        if not self.circuit_breaker.allow():
+            metrics.registry.increment('backend_rejected_requests_total', {'host': self.host, 'reason': 'circuit_open'})
+            raise CircuitOpenError('{} is unavailable, requests are paused'.format(self.host))
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            metrics.registry.increment('backend_rejected_requests_total', {'host': self.host, 'reason': 'busy'})
+            self.circuit_breaker.cancel()  # the backend was not contacted
+            raise HostBusyError('No free request slot for {} within {} s'.format(self.host, self.queue_timeout))
+
+    def release(self, failed):
+        self.slots.release()
+        if self.circuit_breaker.record(failed):
+            metrics.registry.increment('backend_circuit_opened_total', {'host': self.host})
+            print(f"Circuit for {self.host} opened, requests fail fast for {self.circuit_breaker.reset_timeout} s.")
+
+    # Full jitter backoff, at least as long as the backend asked for. None if that is longer than retry_max_delay
+    def get_retry_delay(self, attempt, retry_after=None):
+        if retry_after is not None and retry_after > self.retry_max_delay:
+            return None
+        delay = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt))
+        return max(delay, retry_after or 0)
@@ -1,4 +1,25 @@
+import threading
+import time
+from datetime import datetime, timezone
+from xml.etree import ElementTree
+
 import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from resilience import ResilientHost, TransientError, TRANSIENT_HTTP_STATUS, RETRY_SAFE_HTTP_STATUS, parse_retry_after
+
+# Error codes returned by MediaWiki when the session cookie is no longer valid
+SESSION_EXPIRED_CODES = ('assertuserfailed', 'assertbotfailed', 'assertnameduserfailed')
+# Error codes returned by MediaWiki when the CSRF token is invalid and has to be fetched again
+INVALID_TOKEN_CODES = ('badtoken', 'notoken')
+
+# Namespace of the MediaWiki XML export format used to import many pages with one request
+EXPORT_XML_NAMESPACE = 'http://www.mediawiki.org/xml/export-0.11/'
+
+# Raised by edit with createonly if a page with the title already exists
+class PageExistsError(Exception):
+    pass
 
 class SemanticMediaWikiApiHandler:
     def __init__(self, config):
@@ -6,9 +27,30 @@ class SemanticMediaWikiApiHandler:
         self.username = config.get('SMW', 'username')  # Ensure 'username' exists in the config
         self.password = config.get('SMW', 'password')  # Ensure 'password' exists in the config
         self.session = requests.Session()  # Using session for persistent connections
+        # Keep-alive connection pool, sized for the number of parallel requests on this session
+        connections = config.getint('SMW', 'pool_connections', fallback=10)
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=connections))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=connections))
+        self.timeout = config.getfloat('SMW', 'timeout', fallback=60)  # seconds to wait for the wiki to connect or answer
+        # Requests are rejected with a maxlag error while the database replication lag exceeds this number of seconds
+        self.maxlag = config.get('SMW', 'maxlag', fallback=None)
+        # Retries, concurrency cap and circuit breaker shared by all sessions to the wiki, see [SMW] retries
+        self.resilient_host = ResilientHost.for_url(self.api_url, config, 'SMW')
+        self.import_interwiki_prefix = config.get('SMW', 'import_interwiki_prefix', fallback='eln')  # required by MediaWiki for xml uploads
+        self.stage_timer = None  # StageTimer of the adapt run currently using this handler
+        self.logged_in = False
+        self.login_lock = threading.Lock()  # only one of the threads sharing the handler logs in again
+        self.session_generation = 0  # counted up with each new login, threads which used an older session reuse the new one
+        self.csrf_token = None  # CSRF token is valid for the whole session and reused for all edits
+        self.csrf_token_generation = None  # session generation the token was fetched in
+        self.csrf_token_lock = threading.Lock()
+        self.csrf_token_fetches = 0  # Number of token requests sent to the wiki
+        self.csrf_token_reuses = 0  # Number of edits which used the cached token instead of a new request
         self.login()
 
     def login(self):
+        self.logged_in = False
+
         # Get login token
         login_token_params = {
             'action': 'query',
@@ -17,9 +59,7 @@ class SemanticMediaWikiApiHandler:
             'format': 'json'
         }
         try:
-            response = self.session.get(self.api_url, params=login_token_params)
-            response.raise_for_status()  # Raise an error for bad HTTP response codes
-            login_token = response.json()['query']['tokens']['logintoken']
+            login_token = self.send_with_retry('GET', login_token_params)['query']['tokens']['logintoken']
         except requests.RequestException as e:
             print(f"Login token request failed: {e}")
             return False
@@ -36,10 +76,9 @@ class SemanticMediaWikiApiHandler:
             'format': 'json'
         }
         try:
-            response = self.session.post(self.api_url, data=params)
-            response.raise_for_status()
-            login_result = response.json()
+            login_result = self.send_with_retry('POST', params)
             if login_result['login']['result'] == 'Success':
+                self.logged_in = True
                 return True
             else:
                 print(f"Login failed: {login_result['login'].get('reason', 'Unknown error')}")
@@ -51,6 +90,75 @@ class SemanticMediaWikiApiHandler:
             print("Login result missing in response.")
             return False
 
+    # Logs in again unless another thread has already done so since the session of the given generation was used
+    def renew_session(self, generation):
+        with self.login_lock:
+            if self.session_generation == generation:
+                self.login()
+                self.session_generation += 1
+
+    # Sends an api request as logged in user and logs in again once if the session cookie has expired
+    def request(self, method, params, files=None):
+        params = dict(params, **{'assert': 'user'})
+        if self.maxlag:
+            params['maxlag'] = self.maxlag
+        session_renewed = False
+        while True:
+            generation = self.session_generation
+            if not self.logged_in:
+                self.renew_session(generation)
+                generation = self.session_generation
+            result = self.send_with_retry(method, params, files)
+            if result.get('error', {}).get('code') in SESSION_EXPIRED_CODES and not session_renewed:
+                print("Session expired, logging in again.")
+                self.renew_session(generation)
+                session_renewed = True
+                continue
+            return result
+
+    # Sends an api request through the resilience layer and returns the parsed JSON. Overload (http 503, maxlag, ...)
+    # is retried with backoff, a createonly edit that may have reached the wiki is not sent again
+    def send_with_retry(self, method, params, files=None):
+        return self.resilient_host.call(lambda: self.check_response(params, self.send(method, params, files)),
+                                        idempotent=not params.get('createonly'))
+
+    def check_response(self, params, response):
+        if response.status_code in TRANSIENT_HTTP_STATUS:
+            raise TransientError('Wiki returned http status {}'.format(response.status_code), parse_retry_after(response.headers.get('Retry-After')),
+                                 retry_safe=response.status_code in RETRY_SAFE_HTTP_STATUS)
+        response.raise_for_status()  # Raise an error for bad HTTP response codes
+        result = response.json()
+        error_code = result.get('error', {}).get('code')
+        if error_code:
+            metrics.registry.increment('smw_api_errors_total', {'action': params['action'], 'code': error_code})
+        if error_code == 'maxlag':
+            raise TransientError('Wiki is lagged', parse_retry_after(response.headers.get('Retry-After', 5)), retry_safe=True)  # rejected before processing
+        return result
+
+    # Sends one http request to the api and records its duration and outcome per action
+    def send(self, method, params, files=None):
+        action = params.get('action')
+        if params.get('meta') == 'tokens':
+            action = 'login_token' if params.get('type') == 'login' else 'token'
+        outcome = 'failed'
+        start = time.perf_counter()
+        try:
+            if method == 'GET':
+                response = self.session.get(self.api_url, params=params, timeout=self.timeout)
+            else:
+                response = self.session.post(self.api_url, data=params, files=files, timeout=self.timeout)
+            outcome = str(response.status_code)
+            return response
+        finally:
+            duration = time.perf_counter() - start
+            metrics.registry.increment('smw_api_requests_total', {'action': action, 'outcome': outcome})
+            metrics.registry.observe('smw_api_request_duration_seconds', duration, {'action': action})
+            if self.stage_timer is not None:
+                if 'title' in params:
+                    self.stage_timer.add_span(action, duration, title=params['title'])
+                else:
+                    self.stage_timer.add_span(action, duration)
+
     def ask(self, query):
         # Define the parameters for the SMW query
         params = {
@@ -61,9 +169,7 @@ class SemanticMediaWikiApiHandler:
 
         # Send the SMW query request
         try:
-            response = self.session.get(self.api_url, params=params)
-            response.raise_for_status()  # Raise an error for bad HTTP response codes
-            return response.json()  # Return the parsed JSON data
+            return self.request('GET', params)  # Return the parsed JSON data
         except requests.RequestException as e:
             print(f"Query request failed: {e}")
             return None  # Return None in case of failure
@@ -71,17 +177,29 @@ class SemanticMediaWikiApiHandler:
             print("Failed to parse response as JSON.")
             return None
 
-    def edit(self, title, text):
+    # Returns the cached CSRF token or requests a new one if there is none, it is the rejected token or it was fetched in an
+    # older session. A token rejected by several threads at once is only fetched again by the first of them.
+    def get_csrf_token(self, rejected_token=None):
+        with self.csrf_token_lock:
+            if self.csrf_token and self.csrf_token_generation == self.session_generation and self.csrf_token != rejected_token:
+                self.csrf_token_reuses += 1
+                return self.csrf_token
+
+            csrf_token_params = {
+                'action': 'query',
+                'meta': 'tokens',
+                'format': 'json'
+            }
+            generation = self.session_generation
+            self.csrf_token = self.request('GET', csrf_token_params)['query']['tokens']['csrftoken']
+            self.csrf_token_generation = generation
+            self.csrf_token_fetches += 1
+            return self.csrf_token
+
+    def edit(self, title, text, createonly=False):
         # Get the CSRF token for editing the page
-        csrf_token_params = {
-            'action': 'query',
-            'meta': 'tokens',
-            'format': 'json'
-        }
         try:
-            response = self.session.get(self.api_url, params=csrf_token_params)
-            response.raise_for_status()  # Raise an error for bad HTTP response codes
-            csrf_token = response.json()['query']['tokens']['csrftoken']
+            csrf_token = self.get_csrf_token()
         except requests.RequestException as e:
             print(f"CSRF token request failed: {e}")
             return False
@@ -97,10 +215,18 @@ class SemanticMediaWikiApiHandler:
             'token': csrf_token,
             'format': 'json'
         }
+        if createonly:
+            params['createonly'] = 1  # fail instead of overwriting a page created in the meantime
         try:
-            response = self.session.post(self.api_url, data=params)
-            response.raise_for_status()
-            create_result = response.json()
+            create_result = self.request('POST', params)
+
+            # The cached token was rejected, fetch a new one and try once more
+            if create_result.get('error', {}).get('code') in INVALID_TOKEN_CODES:
+                params['token'] = self.get_csrf_token(rejected_token=params['token'])
+                create_result = self.request('POST', params)
+
+            if create_result.get('error', {}).get('code') == 'articleexists':
+                raise PageExistsError(title)
 
             if 'edit' in create_result and create_result['edit']['result'] == 'Success':
                 print(f"Page '{title}' edited successfully.")
@@ -114,3 +240,66 @@ class SemanticMediaWikiApiHandler:
         except KeyError:
             print("Edit result missing in response.")
             return False
+
+    # Writes many pages with one action=import request (needs the importupload right).
+    # Returns a dictionary with title and True for each imported page or None if the request failed.
+    def import_pages(self, pages):
+        try:
+            csrf_token = self.get_csrf_token()
+        except requests.RequestException as e:
+            print(f"CSRF token request failed: {e}")
+            return None
+        except KeyError:
+            print("CSRF token missing in response.")
+            return None
+
+        params = {
+            'action': 'import',
+            'interwikiprefix': self.import_interwiki_prefix,
+            'summary': 'Import of {} pages'.format(len(pages)),
+            'token': csrf_token,
+            'format': 'json'
+        }
+        try:
+            xml = self.get_import_xml(pages)
+            import_result = self.request('POST', params, {'xml': ('pages.xml', xml, 'application/xml')})
+
+            # The cached token was rejected, fetch a new one and try once more
+            if import_result.get('error', {}).get('code') in INVALID_TOKEN_CODES:
+                params['token'] = self.get_csrf_token(rejected_token=params['token'])
+                import_result = self.request('POST', params, {'xml': ('pages.xml', xml, 'application/xml')})
+
+            if 'import' not in import_result:
+                print(f"Failed to import pages. Response: {import_result}")
+                return None
+            imported_titles = {SemanticMediaWikiApiHandler.normalize_title(page['title']) for page in import_result['import'] if page.get('revisions', 0) > 0}
+            return {title: SemanticMediaWikiApiHandler.normalize_title(title) in imported_titles for title in pages}
+        except requests.RequestException as e:
+            print(f"Import request failed: {e}")
+            return None
+        except (KeyError, ValueError):
+            print("Import result missing in response.")
+            return None
+
+    # Creates an XML dump with one current revision for each page
+    def get_import_xml(self, pages):
+        timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        root = ElementTree.Element('mediawiki', {'xmlns': EXPORT_XML_NAMESPACE, 'version': '0.11'})
+        for title, text in pages.items():
+            page = ElementTree.SubElement(root, 'page')
+            ElementTree.SubElement(page, 'title').text = title
+            ElementTree.SubElement(page, 'ns').text = '0'
+            revision = ElementTree.SubElement(page, 'revision')
+            ElementTree.SubElement(revision, 'timestamp').text = timestamp
+            contributor = ElementTree.SubElement(revision, 'contributor')
+            ElementTree.SubElement(contributor, 'username').text = self.username.split('@')[0]
+            ElementTree.SubElement(revision, 'model').text = 'wikitext'
+            ElementTree.SubElement(revision, 'format').text = 'text/x-wiki'
+            ElementTree.SubElement(revision, 'text', {'xml:space': 'preserve'}).text = text
+        return ElementTree.tostring(root, encoding='utf-8', xml_declaration=True)
+
+    # Titles are returned by MediaWiki with spaces instead of underscores and an upper case first letter
+    @staticmethod
+    def normalize_title(title):
+        title = title.replace('_', ' ').strip()
+        return title[:1].upper() + title[1:]
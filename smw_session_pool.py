@@ -0,0 +1,56 @@
+import queue
+import threading
+from contextlib import contextmanager
+
+from smw_api_handler import SemanticMediaWikiApiHandler
+
+# Raised if no session became free within the pool timeout
+class SessionPoolTimeoutError(Exception):
+    pass
+
+# Process-wide pool of logged in SMW api handlers, shared by all requests
+class SemanticMediaWikiSessionPool:
+    def __init__(self, config):
+        self.config = config
+        self.size = config.getint('SMW', 'pool_size', fallback=4)
+        self.timeout = config.getfloat('SMW', 'pool_timeout', fallback=30)  # seconds to wait for a released handler
+        self.idle_handlers = queue.LifoQueue()  # LIFO keeps the most recently used (warm) sessions in use
+        self.created_handlers = 0
+        self.lock = threading.Lock()
+
+    # Returns an idle handler, creates a new one while the pool is not full or waits for a released one,
+    # at most timeout seconds (default [SMW] pool_timeout)
+    def acquire(self, timeout=None):
+        try:
+            return self.idle_handlers.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            create_handler = self.created_handlers < self.size
+            if create_handler:
+                self.created_handlers += 1
+
+        if create_handler:
+            try:
+                return SemanticMediaWikiApiHandler(self.config)
+            except Exception:
+                with self.lock:
+                    self.created_handlers -= 1
+                raise
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            return self.idle_handlers.get(timeout=timeout)
+        except queue.Empty:
+            raise SessionPoolTimeoutError('All {} SMW sessions are in use, none became free within {} seconds. Please try again later.'.format(self.size, timeout))
+
+    def release(self, handler):
+        self.idle_handlers.put(handler)
+
+    @contextmanager
+    def session(self, timeout=None):
+        handler = self.acquire(timeout)
+        try:
+            yield handler
+        finally:
+            self.release(handler)
@@ -0,0 +1,59 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+# Persistent index of the pages created for each experiment table, so repeated adapt calls
+# write to the same titles and skip pages whose content did not change
+class SyncIndex:
+    instances = {}  # one index per database file and process
+    instances_lock = threading.Lock()
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS smw_pages (
+                origin TEXT NOT NULL,
+                origin_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                category TEXT NOT NULL,
+                title TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (origin, origin_id, position, category))''')
+
+    # Returns the shared index configured in the [Sync] section or None if it is disabled
+    @staticmethod
+    def from_config(config):
+        if not config.getboolean('Sync', 'enabled', fallback=False):
+            return None
+        path = config.get('Sync', 'database', fallback='data/sync.sqlite')
+        if not os.path.isabs(path):
+            path = os.path.join(os.path.dirname(__file__), path)
+        with SyncIndex.instances_lock:
+            if path not in SyncIndex.instances:
+                SyncIndex.instances[path] = SyncIndex(path)
+            return SyncIndex.instances[path]
+
+    @staticmethod
+    def content_hash(text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    # sync_key is (origin, origin internal identifier, position of the table within the experiment)
+    # Returns (title, content hash) of the page created for the key or None
+    def get(self, sync_key, category):
+        origin, origin_id, position = sync_key
+        with self.lock:
+            return self.connection.execute('SELECT title, content_hash FROM smw_pages WHERE origin = ? AND origin_id = ? AND position = ? AND category = ?',
+                                           (origin, str(origin_id), position, category)).fetchone()
+
+    def put(self, sync_key, category, title, content_hash):
+        origin, origin_id, position = sync_key
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO smw_pages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (origin, str(origin_id), position, category, title, content_hash, datetime.now().isoformat()))
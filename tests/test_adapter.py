@@ -0,0 +1,30 @@
+import pytest
+
+from adapter import Adapter
+from sync_index import SyncIndex
+
+SYNC_KEY = ('eLabFTW', '12', 1)
+
+# Adapter with only the sync index, get_synced_smw_page needs nothing else
+@pytest.fixture
+def adapter(tmp_path):
+    adapter = Adapter.__new__(Adapter)
+    adapter.sync_index = SyncIndex(str(tmp_path / 'sync.sqlite'))
+    return adapter
+
+@pytest.mark.parametrize('synced_title, protocol_type, reused', [
+    ('PHT0003', 'HT', True),
+    ('PHTr0003', 'HTr', True),
+    ('PHTr0003', 'HT', False),  # the protocol type was changed from HTr to HT, HT has the prefix of HTr
+    ('PHT0003', 'HTr', False),
+    ('PHT0003', 'H.T', False),
+])
+def test_synced_protocol_page_must_have_title_of_protocol_type(adapter, synced_title, protocol_type, reused):
+    adapter.sync_index.put(SYNC_KEY, 'Protocol', synced_title, 'hash')
+    synced_page = adapter.get_synced_smw_page('Protocol', {'ProtocolType': protocol_type}, SYNC_KEY)
+    assert synced_page == ((synced_title, 'hash') if reused else None)
+
+@pytest.mark.parametrize('synced_title, reused', [('S00042', True), ('S00042a', False), ('PHT0001', False)])
+def test_synced_specimen_page_must_have_specimen_title(adapter, synced_title, reused):
+    adapter.sync_index.put(SYNC_KEY, 'Specimen', synced_title, 'hash')
+    assert (adapter.get_synced_smw_page('Specimen', {}, SYNC_KEY) is not None) == reused
@@ -0,0 +1,40 @@
+import configparser
+
+from field_mapping import MappingEngine
+
+def get_mapping(**options):
+    config = configparser.ConfigParser()
+    config.read_dict({'eLabFTW': options})
+    return MappingEngine(config, 'eLabFTW')
+
+def test_parameters_are_mapped_by_priority():
+    mapping = get_mapping(mapping_person='Experimentator, Person', mapping_date='Datum und Uhrzeit')
+    protocol = {'Person': 'B', 'Experimentator': 'A', 'Temperatur, °C': '900', 'Dauer': '5 min'}
+    mapped, data, missing_keys = mapping.process(protocol, ('person', 'date'))
+    assert mapped == {'person': 'A'}
+    assert data['Temperatur'] == '900 °C' and data['Dauer'] == '5 min'
+    assert missing_keys == ['date']
+
+# A parameter configured for two mapping keys goes to the first of them, the second takes its next parameter or is missing
+def test_parameter_of_several_mapping_keys_is_mapped_once():
+    mapping = get_mapping(mapping_person='Experimentator', mapping_specimen_description='Probe, Experimentator')
+    protocol = {'Experimentator': 'A', 'Dauer': '5 min'}
+    mapped, data, missing_keys = mapping.process(protocol, ('person', 'specimen_description'))
+    assert mapped == {'person': 'A'}
+    assert data == {'Dauer': '5 min'}
+    assert missing_keys == ['specimen_description']
+
+    mapped, _, missing_keys = mapping.process({'Experimentator': 'A', 'Probe': 'SP-1'}, ('person', 'specimen_description'))
+    assert mapped == {'person': 'A', 'specimen_description': 'SP-1'}
+    assert missing_keys == []
+
+def test_claimed_parameter_falls_back_to_next_configured_parameter():
+    mapping = get_mapping(mapping_person='Experimentator', mapping_specimen_description='Experimentator, Probe')
+    mapped, _, missing_keys = mapping.process({'Experimentator': 'A', 'Probe': 'SP-1'}, ('person', 'specimen_description'))
+    assert mapped == {'person': 'A', 'specimen_description': 'SP-1'}
+    assert missing_keys == []
+
+def test_excluded_parameters_are_dropped():
+    mapping = get_mapping(exclude='Ordnername Rohdaten, Filename')
+    _, data, _ = mapping.process({'Filename': 'a.csv', 'Dauer': '5 min'}, ())
+    assert data == {'Dauer': '5 min'}
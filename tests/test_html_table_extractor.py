@@ -0,0 +1,102 @@
+import pytest
+
+from html_table_extractor import extract_tables, table_to_dict
+from plugins.elabftw import parse_elab_protocols
+
+# Sample eLabFTW experiment bodies and the protocols the pandas.read_html implementation read from them
+# (number of tables, protocol dictionaries), without excluded parameters
+SAMPLES = {
+    'two_columns': (
+        '<p>Intro</p><table><tbody><tr><td>Probe</td><td>SP-1</td></tr><tr><td>Experimentator</td><td>A. Meyer</td></tr>'
+        '<tr><td>Datum und Uhrzeit</td><td>24.09.2020 10:30</td></tr><tr><td>Experiment</td><td>HT</td></tr>'
+        '<tr><td>Temperatur, °C</td><td>900 </td></tr></tbody></table>',
+        (1, [{'Probe': 'SP-1', 'Experimentator': 'A. Meyer', 'Datum und Uhrzeit': '24.09.2020 10:30', 'Experiment': 'HT', 'Temperatur, °C': '900'}])),
+    'comments_column': (
+        '<table><tr><td>Parameter</td><td>Value</td><td>Comments</td></tr><tr><td>Probe</td><td>SP-2</td><td>ok</td></tr>'
+        '<tr><td>Experimentator</td><td>B. Schulz</td><td></td></tr><tr><td>Experiment</td><td>TT</td><td>repeated</td></tr>'
+        '<tr><td>Dauer</td><td>5 min</td><td></td></tr></table>',
+        (1, [{'Probe': 'SP-2', 'Experimentator': 'B. Schulz', 'Experiment': 'TT', 'Dauer': '5 min'}])),
+    'measurement_column': (
+        '<table><tr><td>Parameter</td><td>Value</td><td>Measurement</td></tr><tr><td>Probe</td><td>SP-3</td><td>x</td></tr>'
+        '<tr><td>Experimentator</td><td>C. Wagner</td><td>y</td></tr><tr><td>Experiment</td><td>INF</td><td>z</td></tr>'
+        '<tr><td>Länge</td><td>3 mm</td><td>z</td></tr></table>',
+        (1, [{'Probe': 'SP-3', 'Experimentator': 'C. Wagner', 'Experiment': 'INF', 'Länge': '3 mm'}])),
+    'other_third_column': (
+        '<table><tr><td>a</td><td>b</td><td>c</td></tr><tr><td>1 x</td><td>2 y</td><td>3 z</td></tr></table>'
+        '<table><tr><td>Probe</td><td>SP-4</td></tr><tr><td>Experimentator</td><td>A</td></tr><tr><td>Experiment</td><td>HT</td></tr>'
+        '<tr><td>Dauer</td><td>1 h</td></tr></table>',
+        (2, [{'Probe': 'SP-4', 'Experimentator': 'A', 'Experiment': 'HT', 'Dauer': '1 h'}])),
+    'split_table_merged': (
+        '<table><tr><td>Probe</td><td>SP-5</td></tr><tr><td>Experimentator</td><td>A</td></tr></table><p>text</p>'
+        '<table><tr><td>Experiment</td><td>HT</td></tr><tr><td>Dauer</td><td>2 h</td></tr><tr><td>Druck, MPa</td><td>3.5</td></tr></table>',
+        (2, [{'Probe': 'SP-5', 'Experimentator': 'A', 'Experiment': 'HT', 'Dauer': '2 h', 'Druck, MPa': '3.5'}])),
+    'short_table_dropped': (
+        '<table><tr><td>Probe</td><td>SP-6</td></tr><tr><td>Experimentator</td><td>A</td></tr></table>',
+        (1, [])),
+    'th_header_and_empty_cells': (
+        '<table><tr><th>Parameter</th><th>Value</th></tr><tr><td>Probe</td><td>SP-7</td></tr><tr><td>Experimentator</td><td></td></tr>'
+        '<tr><td></td><td>orphan</td></tr><tr><td>Experiment</td><td>HT</td></tr><tr><td>Temperatur, °C</td><td>n/a</td></tr>'
+        '<tr><td>Dauer</td><td>4 min</td></tr><tr><td>Kraft, N</td><td>12 kN</td></tr></table>',
+        (1, [{'Probe': 'SP-7', 'Experiment': 'HT', 'Dauer': '4 min', 'Kraft, N': '12 kN'}])),
+    'thead_tfoot': (
+        '<table><thead><tr><td>Parameter</td><td>Value</td></tr></thead><tbody><tr><td>Probe</td><td>SP-8</td></tr>'
+        '<tr><td>Experimentator</td><td>B</td></tr><tr><td>Experiment</td><td>TT</td></tr></tbody>'
+        '<tfoot><tr><td>Note</td><td>end of table</td></tr></tfoot></table>',
+        (1, [{'Probe': 'SP-8', 'Experimentator': 'B', 'Experiment': 'TT', 'Note': 'end of table'}])),
+    'whitespace_entities_and_line_breaks': (
+        '<table><tr><td> Probe\n</td><td>SP-9  &amp; SP-10</td></tr><tr><td>Experimentator</td><td>M&uuml;ller</td></tr>'
+        '<tr><td>Experiment</td><td>HT</td></tr><tr><td>Beschreibung</td><td>line one<br>line two</td></tr></table>',
+        (1, [{'Probe': 'SP-9 & SP-10', 'Experimentator': 'Müller', 'Experiment': 'HT', 'Beschreibung': 'line one line two'}])),
+    'spans': (
+        '<table><tr><td>Probe</td><td>SP-11</td></tr><tr><td colspan="2">Experimentator</td></tr>'
+        '<tr><td rowspan="2">Experiment</td><td>HT</td></tr><tr><td>TT</td></tr><tr><td>Dauer</td><td>3 min</td></tr></table>',
+        (1, [{'Probe': 'SP-11', 'Experimentator': 'Experimentator', 'Experiment': 'TT', 'Dauer': '3 min'}])),
+    'header_only_table_starts_new_protocol': (
+        '<table><tr><td>Probe</td><td>SP-12</td></tr><tr><td>Experimentator</td><td>A</td></tr><tr><td>Experiment</td><td>HT</td></tr>'
+        '<tr><td>Dauer</td><td>1 h</td></tr></table><table><tr><th>Parameter</th><th>Value</th></tr></table>'
+        '<table><tr><td>Probe</td><td>SP-13</td></tr><tr><td>Experiment</td><td>TT</td></tr></table>'
+        '<table><tr><td>Experimentator</td><td>B</td></tr><tr><td>Dauer</td><td>2 h</td></tr></table>',
+        (4, [{'Probe': 'SP-12', 'Experimentator': 'A', 'Experiment': 'HT', 'Dauer': '1 h'},
+             {'Probe': 'SP-13', 'Experiment': 'TT', 'Experimentator': 'B', 'Dauer': '2 h'}])),
+    'short_table_then_header_only_table': (
+        '<table><tr><td>Probe</td><td>SP-14</td></tr></table><table><tr><th>Parameter</th><th>Value</th></tr></table>'
+        '<table><tr><td>Experimentator</td><td>A</td></tr><tr><td>Experiment</td><td>HT</td></tr><tr><td>Dauer</td><td>1 h</td></tr></table>',
+        (3, [{'Probe': 'SP-14', 'Experimentator': 'A', 'Experiment': 'HT', 'Dauer': '1 h'}])),
+    'no_table': (
+        '<p>No protocol here</p>',
+        (0, [])),
+}
+
+@pytest.mark.parametrize('name', SAMPLES)
+def test_protocols_equal_pandas_output(name):
+    body, expected = SAMPLES[name]
+    assert parse_elab_protocols(body, []) == expected
+
+# Parameters are excluded before protocols with less than four parameters are dropped
+def test_excluded_keys_are_removed():
+    body, _ = SAMPLES['two_columns']
+    assert parse_elab_protocols(body, ['Datum und Uhrzeit']) == (1, [{'Probe': 'SP-1', 'Experimentator': 'A. Meyer', 'Experiment': 'HT', 'Temperatur, °C': '900'}])
+    assert parse_elab_protocols(body, ['Datum und Uhrzeit', 'Temperatur, °C']) == (1, [])
+
+# Intended difference: pandas converted columns with only numbers to floats ({'Probe': 2.5, 'Experimentator': 10.0, ...}),
+# the values are now kept as written in the table
+def test_numeric_values_are_kept_as_strings():
+    body = ('<table><tr><td>Probe</td><td>2.50</td></tr><tr><td>Experimentator</td><td>10</td></tr>'
+            '<tr><td>Experiment</td><td>3</td></tr><tr><td>Dauer</td><td>1.0</td></tr></table>')
+    assert parse_elab_protocols(body, []) == (1, [{'Probe': '2.50', 'Experimentator': '10', 'Experiment': '3', 'Dauer': '1.0'}])
+
+def test_header_only_table_is_empty_dictionary():
+    tables = extract_tables('<table><tr><th>Parameter</th><th>Value</th></tr></table>')
+    assert tables == [[]]
+    assert table_to_dict(tables[0]) == {}
+
+def test_tables_without_parameter_columns_are_skipped():
+    tables = extract_tables('<table><tr><td>Only one column</td></tr></table>'
+                            '<table><tr><th>a</th><th>b</th><th>c</th></tr></table>'
+                            '<table><tr><td>a</td><td>b</td><td>c</td></tr><tr><td>1</td><td>2</td><td>3</td></tr></table>')
+    assert [table_to_dict(table) for table in tables] == [None, None, None]
+
+def test_nested_table_text_belongs_to_outer_cell():
+    tables = extract_tables('<table><tr><td>Probe</td><td>SP<table><tr><td>-15</td></tr></table></td></tr></table>')
+    assert tables[0] == [['Probe', 'SP-15']]
+    assert tables[1] == [['-15']]
@@ -0,0 +1,49 @@
+import configparser
+
+from metrics import MetricsRegistry
+
+def get_config(path):
+    config = configparser.ConfigParser()
+    config.read_dict({'Server': {'metrics_database': str(path), 'metrics_interval': '3600'}})
+    return config
+
+def test_registry_without_database_renders_own_values():
+    registry = MetricsRegistry()
+    registry.increment('adapter_runs_total', {'plugin': 'eLabFTW'})
+    registry.observe('adapter_run_duration_seconds', 0.2, {'plugin': 'eLabFTW'})
+    text = registry.render()
+    assert '# TYPE adapter_runs_total counter' in text
+    assert 'adapter_runs_total{plugin="eLabFTW"} 1' in text
+    assert 'adapter_run_duration_seconds_bucket{plugin="eLabFTW",le="0.25"} 1' in text
+    assert 'adapter_run_duration_seconds_bucket{plugin="eLabFTW",le="0.1"} 0' in text
+
+# Registries of two worker processes sharing one database render the same sums
+def test_workers_render_the_sum_of_all_workers(tmp_path):
+    workers = [MetricsRegistry(), MetricsRegistry()]
+    for worker in workers:
+        worker.share(get_config(tmp_path / 'metrics.sqlite'))
+    workers[0].increment('smw_api_requests_total', {'action': 'edit', 'outcome': '200'}, 2)
+    workers[1].increment('smw_api_requests_total', {'action': 'edit', 'outcome': '200'}, 3)
+    workers[0].observe('smw_api_request_duration_seconds', 0.02, {'action': 'edit'})
+    workers[1].observe('smw_api_request_duration_seconds', 3, {'action': 'edit'})
+    workers[1].write()
+
+    text = workers[0].render()
+    assert text == workers[1].render()
+    assert 'smw_api_requests_total{action="edit",outcome="200"} 5' in text
+    assert 'smw_api_request_duration_seconds_bucket{action="edit",le="0.025"} 1' in text
+    assert 'smw_api_request_duration_seconds_bucket{action="edit",le="5"} 2' in text
+    assert 'smw_api_request_duration_seconds_sum{action="edit"} 3.02' in text
+    assert 'smw_api_request_duration_seconds_count{action="edit"} 2' in text
+
+# A restarted worker starts counting from zero, the counts of the stopped worker are kept
+def test_counters_do_not_go_back_after_worker_restart(tmp_path):
+    stopped_worker = MetricsRegistry()
+    stopped_worker.share(get_config(tmp_path / 'metrics.sqlite'))
+    stopped_worker.increment('adapter_runs_total', {'plugin': 'eLabFTW'}, 4)
+    stopped_worker.write()
+
+    new_worker = MetricsRegistry()
+    new_worker.share(get_config(tmp_path / 'metrics.sqlite'))
+    new_worker.increment('adapter_runs_total', {'plugin': 'eLabFTW'})
+    assert 'adapter_runs_total{plugin="eLabFTW"} 5' in new_worker.render()
@@ -0,0 +1,148 @@
+import configparser
+import contextlib
+import io
+import threading
+import time
+
+import pytest
+import requests
+
+from benchmark.fake_mediawiki import FakeMediaWiki
+from resilience import CircuitBreaker, CircuitOpenError, ResilientHost, TransientError, RETRY_SAFE_HTTP_STATUS
+from smw_api_handler import SemanticMediaWikiApiHandler
+
+def get_config(**options):
+    config = configparser.ConfigParser()
+    config.read_dict({'SMW': dict({'retries': '2', 'retry_base_delay': '0', 'circuit_failure_threshold': '100'}, **options)})
+    return config
+
+# Returns a function raising the errors in order, then returning 'ok', and the list of its calls
+def failing(*errors):
+    calls = []
+
+    def function():
+        calls.append(len(calls))
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return 'ok'
+    return function, calls
+
+def http_error(status):
+    return TransientError('http status {}'.format(status), retry_safe=status in RETRY_SAFE_HTTP_STATUS)
+
+@pytest.mark.parametrize('error, idempotent, retried', [
+    (http_error(502), True, True),
+    (http_error(503), True, True),
+    (http_error(504), True, True),
+    (http_error(429), False, True),
+    (http_error(503), False, True),
+    (http_error(502), False, False),  # a gateway error can arrive after the wiki saved the edit
+    (http_error(504), False, False),
+    (TransientError('Wiki is lagged', retry_safe=True), False, True),
+    (requests.ConnectTimeout(), True, True),
+    (requests.ConnectTimeout(), False, True),  # the request never reached the backend
+    (requests.ReadTimeout(), True, True),
+    (requests.ReadTimeout(), False, False),  # the backend may still process the request
+    (requests.ConnectionError(), False, False),
+])
+def test_retried_errors(error, idempotent, retried):
+    host = ResilientHost('wiki', get_config(), 'SMW')
+    function, calls = failing(error)
+    with contextlib.redirect_stdout(io.StringIO()):
+        if retried:
+            assert host.call(function, idempotent) == 'ok'
+            assert len(calls) == 2
+        else:
+            with pytest.raises(type(error)):
+                host.call(function, idempotent)
+            assert len(calls) == 1
+
+def test_other_errors_are_not_retried_or_counted():
+    host = ResilientHost('wiki', get_config(circuit_failure_threshold='1'), 'SMW')
+    function, calls = failing(KeyError('login'))
+    with pytest.raises(KeyError):
+        host.call(function)
+    assert len(calls) == 1
+    assert host.circuit_breaker.failures == 0
+
+def test_retries_are_limited():
+    host = ResilientHost('wiki', get_config(), 'SMW')
+    function, calls = failing(*[http_error(503)] * 5)
+    with contextlib.redirect_stdout(io.StringIO()), pytest.raises(TransientError):
+        host.call(function)
+    assert len(calls) == 3
+
+def test_retry_after_longer_than_max_delay_is_not_waited_for():
+    host = ResilientHost('wiki', get_config(retry_max_delay='1'), 'SMW')
+    function, calls = failing(TransientError('busy', retry_after=60, retry_safe=True))
+    with pytest.raises(TransientError):
+        host.call(function)
+    assert len(calls) == 1
+
+def open_circuit(circuit_breaker):
+    for _ in range(circuit_breaker.failure_threshold):
+        assert circuit_breaker.allow()
+        circuit_breaker.record(failed=True)
+
+def test_circuit_opens_after_consecutive_failures():
+    host = ResilientHost('wiki', get_config(retries='0', circuit_failure_threshold='2', circuit_reset_timeout='60'), 'SMW')
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(2):
+            with pytest.raises(TransientError):
+                host.call(failing(http_error(503))[0])
+    function, calls = failing()
+    with pytest.raises(CircuitOpenError):
+        host.call(function)
+    assert calls == []
+
+def test_half_open_circuit_lets_one_probe_through_and_closes_on_success():
+    circuit_breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    open_circuit(circuit_breaker)
+    assert not circuit_breaker.allow()
+    time.sleep(0.06)
+    assert circuit_breaker.allow()  # the probe
+    assert not circuit_breaker.allow()  # other requests wait for the probe's result
+    assert not circuit_breaker.record(failed=False)
+    assert circuit_breaker.allow() and circuit_breaker.allow()
+
+def test_failed_probe_opens_circuit_again():
+    circuit_breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    open_circuit(circuit_breaker)
+    time.sleep(0.06)
+    assert circuit_breaker.allow()
+    assert circuit_breaker.record(failed=True)
+    assert not circuit_breaker.allow()
+    time.sleep(0.06)
+    assert circuit_breaker.allow()
+
+def test_cancelled_probe_lets_next_request_through():
+    circuit_breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    open_circuit(circuit_breaker)
+    assert circuit_breaker.allow()
+    circuit_breaker.cancel()
+    assert circuit_breaker.allow()
+
+# Stores the first edit but answers it with a gateway timeout
+class GatewayTimeoutWiki(FakeMediaWiki):
+    def __init__(self):
+        super().__init__()
+        self.timed_out = threading.Event()
+
+    def handle(self, params):
+        status, headers, result = super().handle(params)
+        if params.get('action') == 'edit' and not self.timed_out.is_set():
+            self.timed_out.set()
+            return 504, {}, {}
+        return status, headers, result
+
+def test_createonly_edit_is_not_sent_again_after_gateway_timeout():
+    wiki = GatewayTimeoutWiki().start()
+    try:
+        config = get_config(api_url=wiki.api_url, username='bot', password='secret')
+        with contextlib.redirect_stdout(io.StringIO()):
+            smw_api = SemanticMediaWikiApiHandler(config)
+            assert smw_api.edit('S00001', '{{Specimen}}', createonly=True) is False
+        assert wiki.request_counts['edit'] == 1
+        assert list(wiki.pages) == ['S00001']
+    finally:
+        wiki.stop()
@@ -0,0 +1,85 @@
+import threading
+
+# Template fields per category used if the [Templates] section does not define the category
+DEFAULT_TEMPLATES = {
+    'Specimen': 'Description, Person, Material',
+    'Protocol': 'ProtocolType, Date, Person, SpecimenList, Origin, OriginInternalIdentifier',
+    'Record': 'Protocol, Specimen',
+}
+
+# Characters which would end a template parameter or the template itself are written as HTML entities
+ESCAPE_TABLE = str.maketrans({'|': '&#124;', '=': '&#61;', '{': '&#123;', '}': '&#125;'})
+
+def escape(value):
+    return str(value).translate(ESCAPE_TABLE)
+
+# Template call of one category with its fields in order, the '|Field=' parts are built once
+class PageTemplate:
+    def __init__(self, fields):
+        self.fields = fields
+        self.parameters = ['|{}='.format(escape(field)) for field in fields]
+
+    # Renders '{{Category|Field=value|...}}' followed by one #subobject per dictionary value of data,
+    # subobjects with more than subobject_size entries are split into several (Data, Data_2, ...)
+    def render(self, category, data, subobject_size=0):
+        parts = ['{{', category]
+        for field, parameter in zip(self.fields, self.parameters):
+            parts.append(parameter)
+            parts.append(escape(data[field]))
+        parts.append('}}')
+
+        for name, values in data.items():
+            if not isinstance(values, dict) or name in self.fields:
+                continue
+            items = list(values.items())
+            chunk_size = subobject_size if subobject_size > 0 else max(len(items), 1)
+            for i in range(0, max(len(items), 1), chunk_size):
+                parts.append('{{#subobject:')
+                parts.append(escape(name) if i == 0 else '{}_{}'.format(escape(name), i // chunk_size + 1))
+                for key, value in items[i:i + chunk_size]:
+                    parts.append('|')
+                    parts.append(escape(key))
+                    parts.append('=')
+                    parts.append(escape(value))
+                parts.append('}}')
+        return ''.join(parts)
+
+# Renders SMW pages with the templates of the [Templates] section and of enabled plugins (template_<category> options
+# in the plugin section). Templates are read once per configuration object.
+class WikitextRenderer:
+    renderers = []  # one renderer per configuration object
+    renderers_lock = threading.Lock()
+
+    def __init__(self, config):
+        self.config = config
+        self.subobject_size = config.getint('SMW', 'subobject_size', fallback=0)  # 0 writes each subobject in one piece
+        templates = {category.lower(): fields for category, fields in DEFAULT_TEMPLATES.items()}
+        if config.has_section('Templates'):
+            templates.update(config.items('Templates'))
+        sections = {section.lower(): section for section in config.sections()}  # plugin names are lower case in [Plugins]
+        for plugin in config.options('Plugins') if config.has_section('Plugins') else []:
+            if config.getboolean('Plugins', plugin) and plugin in sections:
+                for option, fields in config.items(sections[plugin]):
+                    if option.startswith('template_'):
+                        templates[option[len('template_'):]] = fields
+        # option names are lower case, the category passed to render is used as template name
+        self.templates = {category: PageTemplate([field.strip() for field in fields.split(',') if field.strip()])
+                          for category, fields in templates.items()}
+
+    # Returns the renderer for the configuration, templates are compiled on the first call
+    @staticmethod
+    def for_config(config):
+        with WikitextRenderer.renderers_lock:
+            for renderer in WikitextRenderer.renderers:
+                if renderer.config is config:
+                    return renderer
+            renderer = WikitextRenderer(config)
+            WikitextRenderer.renderers.append(renderer)
+            return renderer
+
+    # Returns the wikitext of a page or None if there is no template for the category
+    def render(self, category, data):
+        template = self.templates.get(category.lower())
+        if template is None:
+            return None
+        return template.render(category, data, self.subobject_size)